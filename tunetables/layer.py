@@ -710,25 +710,25 @@ class TransformerEncoderLayer(Module):
 
             attn = partial(checkpoint, self.self_attn) if self.recompute_attn else self.self_attn
 
-            global_tokens_src2 = attn(global_tokens_src, global_and_train_tokens_src, global_and_train_tokens_src, None, True, global_src_mask)[0]
-            train_tokens_src2 = attn(train_tokens_src, global_tokens_src, global_tokens_src, None, True, trainset_src_mask)[0]
+            global_tokens_src2 = attn(global_tokens_src, global_and_train_tokens_src, global_and_train_tokens_src, None, False, global_src_mask)[0]
+            train_tokens_src2 = attn(train_tokens_src, global_tokens_src, global_tokens_src, None, False, trainset_src_mask)[0]
             eval_tokens_src2 = attn(eval_tokens_src, src_, src_,
-                                    None, True, valset_src_mask)[0]
+                                    None, False, valset_src_mask)[0]
 
             src2 = torch.cat([global_tokens_src2, train_tokens_src2, eval_tokens_src2], dim=0)
 
         elif isinstance(src_mask, int):
             assert src_key_padding_mask is None
             single_eval_position = src_mask
-            src_left = self.self_attn(src_[:single_eval_position], src_[:single_eval_position], src_[:single_eval_position])[0]
-            src_right = self.self_attn(src_[single_eval_position:], src_[:single_eval_position], src_[:single_eval_position])[0]
+            src_left = self.self_attn(src_[:single_eval_position], src_[:single_eval_position], src_[:single_eval_position], need_weights=False)[0]
+            src_right = self.self_attn(src_[single_eval_position:], src_[:single_eval_position], src_[:single_eval_position], need_weights=False)[0]
             src2 = torch.cat([src_left, src_right], dim=0)
         else:
             if self.recompute_attn:
-                src2 = checkpoint(self.self_attn, src_, src_, src_, src_key_padding_mask, True, src_mask, use_reentrant=True)[0]
+                src2 = checkpoint(self.self_attn, src_, src_, src_, src_key_padding_mask, False, src_mask, use_reentrant=True)[0]
             else:
                 src2 = self.self_attn(src_, src_, src_, attn_mask=src_mask,
-                                      key_padding_mask=src_key_padding_mask)[0]
+                                      key_padding_mask=src_key_padding_mask, need_weights=False)[0]
         src = src + self.dropout1(src2)
         if not self.pre_norm:
             src = self.norm1(src)
@@ -1,9 +1,29 @@
-import gzip
+import os
+import math
 import json
+import hashlib
 from pathlib import Path
 from typing import Optional
 import time
 import warnings
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # ISA-L backed gzip is a drop-in replacement that is several times faster than zlib
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
 
 try:
     import faiss
@@ -11,10 +31,9 @@ except ImportError:
     print("faiss is not available; subset maker will not work until it is installed")
 
 import numpy as np
+import joblib
 from sklearn.preprocessing import LabelEncoder
 from sklearn.impute import SimpleImputer
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import QuantileTransformer, RobustScaler, PowerTransformer, OneHotEncoder
 from sklearn.feature_selection import SelectKBest, mutual_info_classif
 from sklearn.decomposition import PCA
@@ -26,10 +45,11 @@ from sklearn.manifold import LocallyLinearEmbedding
 from sklearn.manifold import TSNE
 
 import torch
-from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data import Dataset, DataLoader, Subset, Sampler
+from torch.utils.data.dataloader import default_collate
 
 
-from tunetables.utils import normalize_data, remove_outliers, normalize_by_used_features_f
+from tunetables.utils import normalize_data, remove_outliers, normalize_by_used_features_f, outlier_bounds, clip_outliers_and_scale
 from tunetables.priors import real
 
 try:
@@ -38,7 +58,16 @@ except ImportError:
     print("umap is not available; subset maker umap will not work until it is installed")
 
 class TabDS(Dataset):
-    def __init__(self, X, y):
+    def __init__(self, X, y, cat_idx=None, cat_dtype=torch.int16, pin_memory=None):
+        """
+        X: feature matrix (numpy array or float tensor)
+        y: labels
+        cat_idx: optional indices of categorical columns in X. If all of their values fit cat_dtype exactly, they
+            are stored as a separate cat_dtype block (and the remaining columns as float32), which shrinks the
+            shared-memory footprint of the dataset. Rows are reassembled into a single float32 tensor on access.
+        pin_memory: keep the stored tensors in page-locked host memory, so that copies of them to the GPU can
+            use non_blocking=True. Defaults to torch.cuda.is_available().
+        """
         #check if NaNs are present in y
         if np.isnan(y).any():
             print("WARNING: NaNs present in y, dropping them")
@@ -49,23 +78,85 @@ class TabDS(Dataset):
             print("New y shape: ", y.shape)
 
         if isinstance(X, np.ndarray):
-            self.X = torch.from_numpy(X.copy().astype(np.float32))
+            self.X = torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
         else:
             self.X = X
 
-        self.y_float = torch.from_numpy(y.copy().astype(np.float32))
-        self.y = torch.from_numpy(y.copy().astype(np.int64))
-
-        print(f"TabDS: X.shape = {self.X.shape}, y.shape = {self.y.shape}")
+        y = np.ascontiguousarray(y)
+        self.y_float = torch.from_numpy(y.astype(np.float32, copy=False))
+        self.y = torch.from_numpy(y.astype(np.int64, copy=False))
+
+        self.num_features = self.X.shape[1]
+        self.X_num = self.X_cat = None
+        if cat_idx is not None and len(cat_idx) > 0:
+            cat_idx = torch.as_tensor(cat_idx, dtype=torch.long)
+            X_cat = self.X[:, cat_idx]
+            if torch.equal(X_cat.to(cat_dtype).to(self.X.dtype), X_cat):
+                num_mask = torch.ones(self.num_features, dtype=torch.bool)
+                num_mask[cat_idx] = False
+                self.num_idx, self.cat_idx = torch.nonzero(num_mask).flatten(), cat_idx
+                self.X_num = self.X[:, self.num_idx].to(torch.float32).contiguous()
+                self.X_cat = X_cat.to(cat_dtype).contiguous()
+                self.X = None
+
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        if pin_memory:
+            for name in ["X", "X_num", "X_cat", "y_float", "y"]:
+                if getattr(self, name) is not None:
+                    setattr(self, name, getattr(self, name).pin_memory())
+
+        print(f"TabDS: X.shape = {(len(self.y), self.num_features)}, y.shape = {self.y.shape}, "
+              f"categorical block: {self.X_cat is not None}")
 
     def __len__(self):
         return len(self.y)
 
+    @property
+    def device(self):
+        return self.y.device
+
+    @property
+    def nbytes(self):
+        return sum(t.nelement() * t.element_size() for t in (self.X, self.X_num, self.X_cat, self.y_float, self.y)
+                   if t is not None)
+
+    def to(self, device, non_blocking=False):
+        """
+        move the stored tensors to device (asynchronously if they are pinned and non_blocking is set)
+        """
+        for name in ["X", "X_num", "X_cat", "y_float", "y", "num_idx", "cat_idx"]:
+            if getattr(self, name, None) is not None:
+                setattr(self, name, getattr(self, name).to(device, non_blocking=non_blocking))
+        return self
+
+    def get_x(self, idx):
+        if self.X is not None:
+            return self.X[idx]
+        x_num, x_cat = self.X_num[idx], self.X_cat[idx]
+        x = torch.empty(x_num.shape[:-1] + (self.num_features,), dtype=torch.float32, device=x_num.device)
+        x[..., self.num_idx] = x_num
+        x[..., self.cat_idx] = x_cat.to(torch.float32)
+        return x
+
     def __getitem__(self, idx):
         #(X,y) data, y target, single_eval_pos
-        ret_item = tuple([self.X[idx], self.y_float[idx]]), self.y[idx], torch.tensor([])
+        ret_item = tuple([self.get_x(idx), self.y_float[idx]]), self.y[idx], torch.tensor([])
         return ret_item
 
+    def __getitems__(self, indices):
+        # batched access (used by DataLoader / Subset on torch>=2.0): one gather per tensor instead of a
+        # __getitem__ call per row followed by default_collate stacking the rows again
+        idx = torch.as_tensor(indices, dtype=torch.long, device=self.device)
+        return tuple([self.get_x(idx), self.y_float[idx]]), self.y[idx], torch.empty(len(idx), 0, device=self.device)
+
+    @staticmethod
+    def collate_fn(batch):
+        # __getitems__ already returns a collated batch; older torch versions fetch a list of items instead
+        if isinstance(batch, list):
+            return default_collate(batch)
+        return batch
+
 class TabularDataset(object):
     def __init__(
         self,
@@ -143,6 +234,11 @@ class TabularDataset(object):
         self.split_indeces = split_indeces
         self.split_source = split_source
 
+        # boolean mask / indices of the numerical features, shared by every process_data call on this dataset
+        self.num_mask = np.ones(num_features, dtype=bool)
+        self.num_mask[cat_idx] = False
+        self.num_idx = np.flatnonzero(self.num_mask)
+
         pass
 
     def target_encode(self):
@@ -165,13 +261,21 @@ class TabularDataset(object):
         self.cat_dims = []
 
         # Preprocess data
-        for i in range(self.num_features):
-            if self.cat_idx and i in self.cat_idx:
+        # For NaN-free numeric columns, np.unique(return_inverse=True) yields the same codes as
+        # LabelEncoder.fit_transform without allocating an encoder per column. Object columns (which may mix
+        # strings with None/NaN) and columns with NaNs keep using LabelEncoder, which handles missing values.
+        for i in sorted(self.cat_idx or []):
+            col = self.X[:, i]
+            if col.dtype == object or np.isnan(col).any():
                 le = LabelEncoder()
-                self.X[:, i] = le.fit_transform(self.X[:, i])
+                self.X[:, i] = le.fit_transform(col)
+                classes = le.classes_
+            else:
+                classes, codes = np.unique(col, return_inverse=True)
+                self.X[:, i] = codes
 
-                # Setting this?
-                self.cat_dims.append(len(le.classes_))
+            # Setting this?
+            self.cat_dims.append(len(classes))
 
     def get_metadata(self) -> dict:
         return {
@@ -186,31 +290,27 @@ class TabularDataset(object):
         }
 
     @classmethod
-    def read(cls, p: Path):
-        """read a dataset from a folder"""
+    def read(cls, p: Path, lazy: Optional[bool] = None):
+        """
+        read a dataset from a folder
+        lazy: memory-map the uncompressed X.npy / y.npy copies (if they were written) instead of decompressing
+            the full arrays into RAM, so only the rows that are indexed get paged in. Defaults to TABPFN_MMAP=1.
+        """
+        if lazy is None:
+            lazy = _mmap_enabled()
 
         # make sure that all required files exist in the directory
-        X_path = p.joinpath("X.npy.gz")
-        y_path = p.joinpath("y.npy.gz")
         metadata_path = p.joinpath("metadata.json")
-        split_indeces_path = p / "split_indeces.npy.gz"
-
-        assert X_path.exists(), f"path to X does not exist: {X_path}"
-        assert y_path.exists(), f"path to y does not exist: {y_path}"
+        for name in ["X", "y", "split_indeces"]:
+            assert _array_exists(p, name), f"path to {name} does not exist: {p / name}.b2nd or {p / name}.npy.gz"
         assert (
             metadata_path.exists()
         ), f"path to metadata does not exist: {metadata_path}"
-        assert (
-            split_indeces_path.exists()
-        ), f"path to split indeces does not exist: {split_indeces_path}"
 
         # read data
-        with gzip.GzipFile(X_path, "r") as f:
-            X = np.load(f, allow_pickle=True)
-        with gzip.GzipFile(y_path, "r") as f:
-            y = np.load(f)
-        with gzip.GzipFile(split_indeces_path, "rb") as f:
-            split_indeces = np.load(f, allow_pickle=True)
+        X = _load_array(p, "X", allow_pickle=True, mmap=lazy)
+        y = _load_array(p, "y", mmap=lazy)
+        split_indeces = _load_array(p, "split_indeces", allow_pickle=True)
 
         # read metadata
         with open(metadata_path, "r") as f:
@@ -219,8 +319,14 @@ class TabularDataset(object):
         kwargs["X"], kwargs["y"], kwargs["split_indeces"] = X, y, split_indeces
         return cls(**kwargs)
 
-    def write(self, p: Path, overwrite=False) -> None:
-        """write the dataset to a new folder. this folder cannot already exist"""
+    def write(self, p: Path, overwrite=False, lazy: Optional[bool] = None) -> None:
+        """
+        write the dataset to a new folder. this folder cannot already exist
+        lazy: additionally write uncompressed X.npy / y.npy copies that read(lazy=True) can memory-map.
+            Defaults to TABPFN_MMAP=1.
+        """
+        if lazy is None:
+            lazy = _mmap_enabled()
 
         if not overwrite:
             assert ~p.exists(), f"the path {p} already exists."
@@ -229,18 +335,89 @@ class TabularDataset(object):
         p.mkdir(parents=True, exist_ok=overwrite)
 
         # write data
-        with gzip.GzipFile(p.joinpath("X.npy.gz"), "w") as f:
-            np.save(f, self.X)
-        with gzip.GzipFile(p.joinpath("y.npy.gz"), "w") as f:
-            np.save(f, self.y)
-        with gzip.GzipFile(p.joinpath("split_indeces.npy.gz"), "wb") as f:
-            np.save(f, self.split_indeces)
+        _save_array(p, "X", self.X, raw=lazy)
+        _save_array(p, "y", self.y, raw=lazy)
+        _save_array(p, "split_indeces", self.split_indeces)
 
         # write metadata
         with open(p.joinpath("metadata.json"), "w") as f:
             metadata = self.get_metadata()
             json.dump(self.get_metadata(), f, indent=4)
 
+_READ_BUFFER_SIZE = 4 * 1024 * 1024
+# below this compressed size, spinning up the parallel decompressor costs more than it saves
+_PARALLEL_GZIP_MIN_SIZE = 1024 * 1024 * 1024
+_WRITE_BLOCK_SIZE = 64 * 1024 * 1024
+
+def _mmap_enabled() -> bool:
+    return os.environ.get("TABPFN_MMAP", "0") == "1"
+
+def _array_exists(p: Path, name: str) -> bool:
+    return p.joinpath(f"{name}.b2nd").exists() or p.joinpath(f"{name}.npy.gz").exists()
+
+def _save_array(p: Path, name: str, arr: np.ndarray, raw: bool = False) -> None:
+    """
+    Save arr as <name>.b2nd (chunked, multithreaded Blosc2+Zstd) when blosc2 is installed and the dtype is
+    not object, otherwise as a gzipped <name>.npy.gz. If raw is set, an uncompressed <name>.npy that can be
+    memory-mapped is written next to it.
+    """
+    arr = np.asanyarray(arr)
+    b2nd_path, gz_path = p.joinpath(f"{name}.b2nd"), p.joinpath(f"{name}.npy.gz")
+    if blosc2 is not None and arr.dtype != object:
+        cparams = {
+            "codec": blosc2.Codec.ZSTD,
+            "clevel": 5,
+            "nthreads": os.cpu_count(),
+            "filters": [blosc2.Filter.SHUFFLE],
+        }
+        # fill the container block by block so that at most one block of a non-contiguous arr (e.g. a
+        # fancy-indexed view) is copied at a time, instead of materializing a contiguous copy of the whole array
+        out = blosc2.empty(arr.shape, dtype=arr.dtype, urlpath=str(b2nd_path), mode="w", cparams=cparams)
+        block_rows = max(1, _WRITE_BLOCK_SIZE // max(1, arr[:1].nbytes))
+        for start in range(0, arr.shape[0], block_rows):
+            out[start:start + block_rows] = np.ascontiguousarray(arr[start:start + block_rows])
+        stale_path = gz_path
+    else:
+        # compresslevel=1 is ~2x faster than the default with a negligible size difference for numeric arrays
+        with gzip.open(gz_path, "wb", compresslevel=1) as f:
+            np.save(f, arr)
+        stale_path = b2nd_path
+    # never leave an outdated copy in the other format behind, since read prefers .b2nd
+    if stale_path.exists():
+        stale_path.unlink()
+
+    # object arrays are pickled and cannot be memory-mapped
+    raw_path = p.joinpath(f"{name}.npy")
+    if raw and arr.dtype != object:
+        np.save(raw_path, arr)
+    elif raw_path.exists():
+        raw_path.unlink()
+
+def _load_array(p: Path, name: str, allow_pickle: bool = False, mmap: bool = False) -> np.ndarray:
+    """
+    Load <name>.b2nd if present, otherwise fall back to the legacy <name>.npy.gz. When the uncompressed
+    <name>.npy exists it is read directly instead, as a read-only memory map if mmap is set.
+    """
+    raw_path = p.joinpath(f"{name}.npy")
+    if raw_path.exists():
+        if mmap:
+            return np.load(raw_path, mmap_mode="r")
+        # the uncompressed copy is the cheapest eager read, it skips the decompressor entirely
+        with open(raw_path, "rb") as f:
+            return np.lib.format.read_array(f, allow_pickle=allow_pickle)
+    b2nd_path = p.joinpath(f"{name}.b2nd")
+    if b2nd_path.exists():
+        assert blosc2 is not None, f"blosc2 must be installed to read {b2nd_path}"
+        return blosc2.open(str(b2nd_path))[:]
+    gz_path = p.joinpath(f"{name}.npy.gz")
+    if rapidgzip is not None and gz_path.stat().st_size >= _PARALLEL_GZIP_MIN_SIZE:
+        # stdlib gzip is single-threaded; rapidgzip decompresses chunks of large files in parallel
+        with rapidgzip.open(str(gz_path), parallelization=os.cpu_count()) as f:
+            return np.load(f, allow_pickle=allow_pickle)
+    # give the decompressor a large read buffer so it does a few big reads instead of many 8 KiB ones.
+    # np.load treats io.BufferedReader as a real file, so the buffer has to sit below the gzip stream.
+    with open(gz_path, "rb", buffering=_READ_BUFFER_SIZE) as raw, gzip.open(raw, "rb") as f:
+        return np.load(f, allow_pickle=allow_pickle)
 
 
 class CoresetSampler:
@@ -287,8 +464,6 @@ class SubsetMaker(object):
         self, subset_features, subset_rows, subset_features_method, subset_rows_method, seed = 135798642, give_full_features=False
     ):
 
-        np.random.seed(seed)
-
         self.subset_features = subset_features
         self.subset_rows = subset_rows
         self.subset_features_method = subset_features_method
@@ -298,29 +473,35 @@ class SubsetMaker(object):
         self.give_full_features = give_full_features
         self.seed = seed
 
-    def random_subset(self, X, y, action=[]):
+    @staticmethod
+    def _take(X, y, row_indices=None, feature_indices=None):
+        # gather along one axis at a time (None keeps the whole axis) instead of 2-D fancy indexing, which
+        # broadcasts an index array of the full output size
+        if row_indices is not None:
+            X, y = np.take(X, row_indices, axis=0), np.take(y, row_indices, axis=0)
+        if feature_indices is not None:
+            X = np.take(X, feature_indices, axis=1)
+        return X, y
+
+    def random_subset(self, X, y, action=[], rng=None):
+        if rng is None:
+            rng = np.random.default_rng(self.seed)
+        row_indices = feature_indices = None
         if "rows" in action:
-            row_indices = np.random.choice(X.shape[0], self.subset_rows, replace=False)
-        else:
-            row_indices = np.arange(X.shape[0])
+            row_indices = rng.choice(X.shape[0], self.subset_rows, replace=False, shuffle=False)
         if "features" in action:
-            feature_indices = np.random.choice(
-                X.shape[1], self.subset_features, replace=False
+            feature_indices = rng.choice(
+                X.shape[1], self.subset_features, replace=False, shuffle=False
             )
-        else:
-            feature_indices = np.arange(X.shape[1])
-        return X[row_indices[:, None], feature_indices], y[row_indices]
+        return self._take(X, y, row_indices, feature_indices)
 
     def first_subset(self, X, y, action=[]):
+        # leading rows / features are plain slices
         if "rows" in action:
-            row_indices = np.arange(self.subset_rows)
-        else:
-            row_indices = np.arange(X.shape[0])
+            X, y = X[:self.subset_rows], y[:self.subset_rows]
         if "features" in action:
-            feature_indices = np.arange(self.subset_features)
-        else:
-            feature_indices = np.arange(X.shape[1])
-        return X[row_indices[:, None], feature_indices], y[row_indices]
+            X = X[:, :self.subset_features]
+        return X.copy(), y.copy()
 
     def mutual_information_subset(self, X, y, action="features", split="train"):
         if split not in ["train", "val", "test"]:
@@ -328,16 +509,29 @@ class SubsetMaker(object):
         if split == "train":
             # NOTE: we are only fitting on the first split we see to save time here
             if getattr(self, "feature_selector", None) is None:
+                # the fit is expensive and deterministic given the data, so reuse it across runs
+                cache_path = self._mutual_information_cache_path(X, y)
+                if cache_path is not None and cache_path.exists():
+                    print(f"Loading cached mutual information feature selector from {cache_path} ...")
+                    self.feature_selector = joblib.load(cache_path)
+                    X = self.feature_selector.transform(X)
+                    return X, y
                 print("Fitting mutual information feature selector ...")
                 # start the timer
                 timer = time.time()
                 self.feature_selector = SelectKBest(
-                    mutual_info_classif, k=self.subset_features
+                    partial(mutual_info_classif, random_state=self.seed), k=self.subset_features
                 )
                 X = self.feature_selector.fit_transform(X, y)
                 print(
                     f"Done fitting mutual information feature selector in {round(time.time() - timer, 1)} seconds"
                 )
+                if cache_path is not None:
+                    try:
+                        cache_path.parent.mkdir(parents=True, exist_ok=True)
+                        joblib.dump(self.feature_selector, cache_path)
+                    except OSError as e:
+                        print("Could not cache mutual information feature selector: ", e)
             else:
                 X = self.feature_selector.transform(X)
             return X, y
@@ -345,6 +539,17 @@ class SubsetMaker(object):
             X = self.feature_selector.transform(X)
             return X, y
 
+    def _mutual_information_cache_path(self, X, y):
+        # object arrays would hash their PyObject pointers, which differ on every load, so they are not cached
+        X, y = np.asarray(X), np.asarray(y)
+        if X.dtype == object or y.dtype == object:
+            return None
+        key = hashlib.sha1(f"{X.shape}-{X.dtype}-{self.subset_features}-{self.seed}".encode())
+        key.update(np.ascontiguousarray(X).tobytes())
+        key.update(np.ascontiguousarray(y).tobytes())
+        cache_dir = Path(os.environ.get("TABPFN_CACHE_DIR", "~/.cache/tabpfn")).expanduser()
+        return cache_dir / "mi" / f"{key.hexdigest()}.joblib"
+
     def pca_subset(self, X, y, action='features', split='train'):
         if split not in ["train", "val", "test"]:
             raise ValueError("split must be 'train', 'val', or 'test'")        
@@ -551,8 +756,9 @@ class SubsetMaker(object):
         :param subset_rows_method: method to use for selecting rows
         :return: subset of X, y
         """
-        # print('setting numpy seed to', seed)
-        # np.random.seed(seed)
+        # local generator: does not touch the global numpy RNG, and the same seed picks the same random
+        # features for the train, val and test splits
+        rng = np.random.default_rng(seed)
         if self.give_full_features:
                 pass
         else:
@@ -561,7 +767,7 @@ class SubsetMaker(object):
                     f"making {self.subset_features}-sized subset of {X.shape[1]} features ..."
                 )
                 if self.subset_features_method == "random":
-                    X, y = self.random_subset(X, y, action=["features"])
+                    X, y = self.random_subset(X, y, action=["features"], rng=rng)
                 elif self.subset_features_method == "first":
                     X, y = self.first_subset(X, y, action=["features"])
                 elif self.subset_features_method == "mutual_information":
@@ -595,7 +801,7 @@ class SubsetMaker(object):
             print(f"making {self.subset_rows}-sized subset of {X.shape[0]} rows ...")
 
             if self.subset_rows_method == "random":
-                X, y = self.random_subset(X, y, action=["rows"])
+                X, y = self.random_subset(X, y, action=["rows"], rng=rng)
             elif self.subset_rows_method == "first":
                 X, y = self.first_subset(X, y, action=["rows"])
             elif self.subset_rows_method == "kmeans":
@@ -618,7 +824,7 @@ import pandas as pd
 def data_split(X, y, nan_mask): # indices
     x_d = {
         'data': X,
-        'mask': nan_mask.values
+        'mask': np.asarray(nan_mask)
     }
 
     if x_d['data'].shape != x_d['mask'].shape:
@@ -631,8 +837,8 @@ def data_split(X, y, nan_mask): # indices
 
 
 def data_prep(X, y):
-    temp = pd.DataFrame(X).fillna("MissingValue")
-    nan_mask = temp.ne("MissingValue").astype(int)
+    # pd.isna is a single vectorized pass (np.isnan for float X) and, unlike np.isnan, also handles object arrays
+    nan_mask = (~pd.isna(X)).astype(int)
     X, y = data_split(X, y, nan_mask)
     return X, y
 
@@ -660,56 +866,71 @@ def process_data(
 
     print("Do impute: ", impute)
 
-    num_mask = np.ones(dataset.X.shape[1], dtype=int)
-    num_mask[dataset.cat_idx] = 0
+    # num_mask is boolean, so X[:, num_mask] selects the numerical columns
+    num_mask, num_idx = dataset.num_mask, dataset.num_idx
 
     # Impute numerical features
     if impute:
-        num_idx = np.where(num_mask)[0]
-
-        # The imputer drops columns that are fully NaN. So, we first identify columns that are fully NaN and set them to
-        # zero. This will effectively drop the columns without changing the column indexing and ordering that many of
-        # the functions in this repository rely upon.
-        fully_nan_num_idcs = np.nonzero(
-            (~np.isnan(X_train[:, num_idx].astype("float"))).sum(axis=0) == 0
-        )[0]
+
+        # Object arrays can hold string categories, so only their numerical columns are cast; their categorical
+        # columns keep going through SimpleImputer. Everything else is imputed as float64 in place below.
+        object_cats = X_train.dtype == object and len(dataset.cat_idx) > 0
+        if object_cats:
+            for x in (X_train, X_val, X_test):
+                x[:, num_idx] = x[:, num_idx].astype(np.float64)
+        else:
+            X_train, X_val, X_test = (x.astype(np.float64) for x in (X_train, X_val, X_test))
+
+        # The imputation statistics only depend on the train rows, and make_datasets calls this again for every
+        # ensemble member / bag on the same split, so they are cached on the dataset
+        train_key = hashlib.sha1(np.ascontiguousarray(train_index).tobytes()).hexdigest()
+        cached = getattr(dataset, "_impute_cache", None)
+        if cached is not None and cached[0] == train_key:
+            _, fully_nan_num_idcs, fill, cat_imputer = cached
+        else:
+            fully_nan_num_idcs = np.nonzero(np.isnan(X_train[:, num_idx].astype(np.float64)).all(axis=0))[0]
+            fill = None
+
+        # Columns that are fully NaN in the train split are set to zero. This effectively drops them without
+        # changing the column indexing and ordering that many of the functions in this repository rely upon.
         if fully_nan_num_idcs.size > 0:
             print(f"Fully NaN numerical features: {fully_nan_num_idcs}")
             X_train[:, num_idx[fully_nan_num_idcs]] = 0
             X_val[:, num_idx[fully_nan_num_idcs]] = 0
             X_test[:, num_idx[fully_nan_num_idcs]] = 0
 
-        # Impute numerical and categorical features
-        numeric_transformer = Pipeline(steps=[("imputer", SimpleImputer(strategy="mean"))])
-        categorical_transformer = Pipeline(steps=[("imputer", SimpleImputer(strategy="most_frequent"))])
-        preprocessor = ColumnTransformer(
-            transformers=[
-                ("num", numeric_transformer, num_idx),
-                # ("pass", "passthrough", dataset.cat_idx),
-                ("cat", categorical_transformer, dataset.cat_idx),
-            ],
-            # remainder="passthrough",
-        )
-        X_train = preprocessor.fit_transform(X_train)
-        X_val = preprocessor.transform(X_val)
-        X_test = preprocessor.transform(X_test)
-
-        # Re-order columns (ColumnTransformer permutes them)
-        perm_idx = []
-        running_num_idx = 0
-        running_cat_idx = 0
-        for is_num in num_mask:
-            if is_num > 0:
-                perm_idx.append(running_num_idx)
-                running_num_idx += 1
+        # Impute numerical features with the train mean and categorical features with the most frequent train
+        # value. This matches SimpleImputer(strategy="mean") / SimpleImputer(strategy="most_frequent"), but fills
+        # in place, so the columns keep their order and no ColumnTransformer permutation has to be undone.
+        if fill is None:
+            fill = np.zeros(num_mask.size)
+            fill[num_idx] = np.nanmean(X_train[:, num_idx].astype(np.float64), axis=0)
+            cat_imputer = None
+            if object_cats:
+                cat_imputer = SimpleImputer(strategy="most_frequent").fit(X_train[:, dataset.cat_idx])
             else:
-                perm_idx.append(running_cat_idx + len(num_idx))
-                running_cat_idx += 1
-        assert running_num_idx == len(num_idx)
-        assert running_cat_idx == len(dataset.cat_idx)
-        X_train = X_train[:, perm_idx]
-        X_val = X_val[:, perm_idx]
-        X_test = X_test[:, perm_idx]
+                for i in dataset.cat_idx:
+                    values, counts = np.unique(X_train[:, i], return_counts=True)
+                    counts, values = counts[~np.isnan(values)], values[~np.isnan(values)]
+                    # np.unique sorts, so argmax breaks ties towards the smallest value like SimpleImputer does
+                    if values.size > 0:
+                        fill[i] = values[np.argmax(counts)]
+            dataset._impute_cache = (train_key, fully_nan_num_idcs, fill, cat_imputer)
+
+        def fill_nans(X):
+            if cat_imputer is None:
+                nan_rows, nan_cols = np.nonzero(np.isnan(X))
+                X[nan_rows, nan_cols] = fill[nan_cols]
+            else:
+                X_num = X[:, num_idx].astype(np.float64)
+                nan_rows, nan_cols = np.nonzero(np.isnan(X_num))
+                X_num[nan_rows, nan_cols] = fill[num_idx[nan_cols]]
+                X[:, num_idx] = X_num
+                X[:, dataset.cat_idx] = cat_imputer.transform(X[:, dataset.cat_idx])
+
+        # the splits are independent and numpy releases the GIL, so fill them concurrently
+        with ThreadPoolExecutor(3) as ex:
+            list(ex.map(fill_nans, (X_train, X_val, X_test)))
 
     if scaler != "None":
         if verbose:
@@ -722,10 +943,13 @@ def process_data(
         ohe = OneHotEncoder(sparse=False, handle_unknown="ignore")
         new_x1 = ohe.fit_transform(X_train[:, dataset.cat_idx])
         X_train = np.concatenate([new_x1, X_train[:, num_mask]], axis=1)
-        new_x1_test = ohe.transform(X_test[:, dataset.cat_idx])
-        X_test = np.concatenate([new_x1_test, X_test[:, num_mask]], axis=1)
-        new_x1_val = ohe.transform(X_val[:, dataset.cat_idx])
-        X_val = np.concatenate([new_x1_val, X_val[:, num_mask]], axis=1)
+
+        def encode(X):
+            return np.concatenate([ohe.transform(X[:, dataset.cat_idx]), X[:, num_mask]], axis=1)
+
+        # the fitted encoder is shared read-only, so val and test can be encoded concurrently
+        with ThreadPoolExecutor(2) as ex:
+            X_val, X_test = ex.map(encode, (X_val, X_test))
         if verbose:
             print("New Shape:", X_train.shape)
 
@@ -830,6 +1054,50 @@ def loop_translate(a, my_dict):
         # print("new_a: ", new_a[:5, ...])
     return new_a
 
+def _interp(x, xp, fp):
+    """
+    np.interp applied row-wise: x is (F, N), xp is (F, Q) and non-decreasing along dim 1, fp is (Q,)
+    """
+    idx = torch.searchsorted(xp, x, right=True).clamp(1, xp.shape[1] - 1)
+    x0, x1 = xp.gather(1, idx - 1), xp.gather(1, idx)
+    f0, f1 = fp[idx - 1], fp[idx]
+    w = torch.where(x1 > x0, (x - x0) / (x1 - x0), torch.zeros_like(x))
+    out = f0 + w * (f1 - f0)
+    out = torch.where(x >= xp[:, -1:], fp[-1], out)
+    return torch.where(x < xp[:, :1], fp[0], out)
+
+def quantile_transform_normal(eval_xs, eval_position, n_quantiles=1000):
+    """
+    Torch port of QuantileTransformer(output_distribution='normal').fit(eval_xs[:eval_position]).transform(eval_xs)
+    that stays on the device of eval_xs. Quantiles are computed from all fit rows (sklearn subsamples 10k rows).
+    eval_xs must not contain NaNs.
+    """
+    bounds_threshold = 1e-7
+    x = eval_xs.to(torch.float64).T.contiguous()
+    references = torch.linspace(0, 1, n_quantiles, dtype=torch.float64, device=x.device)
+    # linear interpolation between order statistics, like np.percentile
+    sorted_xs = torch.sort(x[:, :eval_position], dim=1).values
+    pos = references * (eval_position - 1)
+    lo = pos.floor().long()
+    hi = pos.ceil().long()
+    quantiles = sorted_xs[:, lo] + (pos - lo) * (sorted_xs[:, hi] - sorted_xs[:, lo])
+    # sklearn makes the quantiles monotonic the same way, to undo floating point error in the interpolation
+    quantiles = torch.cummax(quantiles, dim=1).values
+
+    lower_bounds = x - bounds_threshold < quantiles[:, :1]
+    upper_bounds = x + bounds_threshold > quantiles[:, -1:]
+    # interpolate in both directions and average, which handles repeated quantiles
+    out = 0.5 * (_interp(x, quantiles, references)
+                 - _interp(-x, -quantiles.flip(1), -references.flip(0)))
+    out = torch.where(upper_bounds, torch.ones_like(out), out)
+    out = torch.where(lower_bounds, torch.zeros_like(out), out)
+
+    # normal ppf, clipped like sklearn so that the bounds map to finite values
+    eps = np.spacing(1)
+    clip_min = math.sqrt(2) * torch.erfinv(torch.tensor(2 * (bounds_threshold - eps) - 1, dtype=torch.float64)).item()
+    out = (math.sqrt(2) * torch.erfinv(2 * out - 1)).clamp(clip_min, -clip_min)
+    return out.T.to(eval_xs.dtype)
+
 def preprocess_input(eval_xs, preprocess_transform, summerize_after_prep, args, is_train=False):
 
     if preprocess_transform != 'none':
@@ -849,55 +1117,201 @@ def preprocess_input(eval_xs, preprocess_transform, summerize_after_prep, args,
     eval_xs = eval_xs[:, args.sel]
 
     warnings.simplefilter('error')
-    if preprocess_transform != 'none':
+    if preprocess_transform in ('quantile', 'quantile_all') and not torch.isnan(eval_xs).any():
+        # with fewer rows than quantiles, sklearn warns (an error here), which left the features untransformed
+        if eval_position >= pt.n_quantiles:
+            eval_xs = quantile_transform_normal(eval_xs.float(), eval_position, n_quantiles=pt.n_quantiles)
+    elif preprocess_transform != 'none':
         eval_xs = eval_xs.cpu().numpy()
-        feats = set(range(eval_xs.shape[1]))
-        for col in feats:
-            try:
-                pt.fit(eval_xs[0:eval_position, col:col + 1])
-                trans = pt.transform(eval_xs[:, col:col + 1])
-                eval_xs[:, col:col + 1] = trans
-            except:
-                pass
+        try:
+            # all supported transformers treat columns independently, so one fit over the whole matrix
+            # matches fitting column by column
+            pt.fit(eval_xs[0:eval_position])
+            eval_xs = pt.transform(eval_xs)
+        except:
+            # some column failed (or warned); fit column by column so only the failing ones stay untransformed
+            feats = set(range(eval_xs.shape[1]))
+            for col in feats:
+                try:
+                    pt.fit(eval_xs[0:eval_position, col:col + 1])
+                    trans = pt.transform(eval_xs[:, col:col + 1])
+                    eval_xs[:, col:col + 1] = trans
+                except:
+                    pass
         eval_xs = torch.tensor(eval_xs).float()
     warnings.simplefilter('default')
 
     eval_xs = eval_xs.unsqueeze(1)
 
-    eval_xs = remove_outliers(eval_xs, normalize_positions=eval_position)
     # Rescale X
     #hard-coded
     max_features = 100
 
     if summerize_after_prep:
-        eval_xs = normalize_by_used_features_f(eval_xs, min(eval_xs.shape[-1],max_features), max_features,
-                                            normalize_with_sqrt=False)        
+        num_features_used = min(eval_xs.shape[-1],max_features)
     else:
-        eval_xs = normalize_by_used_features_f(eval_xs, eval_xs.shape[-1], max_features,
-                                                normalize_with_sqrt=False)
+        num_features_used = eval_xs.shape[-1]
+
+    # remove_outliers followed by normalize_by_used_features_f (without sqrt), in a single elementwise pass
+    lower, upper = outlier_bounds(eval_xs, normalize_positions=eval_position)
+    eval_xs = clip_outliers_and_scale(eval_xs, lower, upper, num_features_used / max_features)
 
     eval_xs = eval_xs.squeeze(1)
     return eval_xs
 
-def get_train_dataloader(ds, bptt=1000, shuffle=True, num_workers=1, drop_last=True, agg_k_grads=1, not_zs=True):
-        dl = DataLoader(
-            ds, batch_size=bptt, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
-        )
-        if len(dl) == 0:
-            ds_len = len(ds)
+class TabDSLoader:
+    """
+    In-process replacement for DataLoader over a device-resident TabDS (or a Subset of one): each batch is one
+    gather of a slice of a (shuffled) index tensor, without a sampler, worker processes or collation.
+    Mirrors the DataLoader attributes used in this repository. Shuffled orders come from the loader's own generator
+    (seeded from the global CPU generator), so they don't depend on, or consume, the global CUDA generator.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_workers = 0
+        self.collate_fn = TabDS.collate_fn
+        if isinstance(dataset, Subset):
+            self._base = dataset.dataset
+            self._indices = torch.as_tensor(dataset.indices, dtype=torch.long, device=self._base.device)
+        else:
+            self._base, self._indices = dataset, None
+        self.generator = None
+        if shuffle:
+            self.generator = torch.Generator(device=self._base.device)
+            self.generator.manual_seed(int(torch.randint(2 ** 62, (1,)).item()))
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        n, device = len(self.dataset), self._base.device
+        order = torch.randperm(n, device=device, generator=self.generator) if self.shuffle else torch.arange(n, device=device)
+        if self.drop_last:
+            order = order[:len(self) * self.batch_size]
+        if self._indices is not None:
+            order = self._indices[order]
+        for idx in order.split(self.batch_size):
+            yield self._base.__getitems__(idx)
+
+def tabds_loader(ds, batch_size, shuffle=False, num_workers=1, drop_last=False, persistent_workers=True):
+    """
+    TabDSLoader if the tensors of ds live on the GPU (DataLoader workers cannot serve them, and slicing on the device
+    avoids any host-to-device copies), otherwise a regular DataLoader. Pass persistent_workers=False for loaders that
+    are rebuilt soon, so that their worker processes don't outlive them
+    """
+    base = ds.dataset if isinstance(ds, Subset) else ds
+    if isinstance(base, TabDS) and base.device.type == "cuda":
+        return TabDSLoader(ds, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last)
+    return DataLoader(
+        ds, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last, collate_fn=TabDS.collate_fn,
+        pin_memory=torch.cuda.is_available(), persistent_workers=persistent_workers and num_workers > 0,
+    )
+
+class BagSampler(Sampler):
+    """
+    Yields a replaceable array of row indices in order, so that one DataLoader (and its workers) can serve every bag
+    """
+    def __init__(self, indices):
+        self.indices = indices
+
+    def __iter__(self):
+        return iter(np.asarray(self.indices).tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+def bagging_loader(ds, indices, batch_size, num_workers=1, loader=None, persistent_workers=True):
+    """
+    Loader over the rows indices of ds, in order and without a last partial batch. If loader is the one returned
+    for the previous bag over the same ds, only its indices are swapped, which keeps its worker processes alive
+    """
+    if isinstance(ds, TabDS) and ds.device.type == "cuda":
+        return TabDSLoader(Subset(ds, indices), batch_size=batch_size, shuffle=False, drop_last=True)
+    if isinstance(loader, DataLoader) and loader.dataset is ds and loader.batch_size == batch_size \
+            and isinstance(loader.sampler, BagSampler):
+        loader.sampler.indices = indices
+        return loader
+    return DataLoader(
+        ds, batch_size=batch_size, sampler=BagSampler(indices), num_workers=num_workers, drop_last=True,
+        collate_fn=TabDS.collate_fn, pin_memory=torch.cuda.is_available(),
+        persistent_workers=persistent_workers and num_workers > 0, prefetch_factor=4 if num_workers > 0 else None,
+    )
+
+class CUDAPrefetcher:
+    """
+    Wraps a loader of host-side batches and copies the next batch to the device on a side stream
+    while the current one is being used, so host-to-device copies overlap with compute.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def _to_device(self, obj):
+        if torch.is_tensor(obj):
+            return obj.to(self.device, non_blocking=True)
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_device(o) for o in obj)
+        return obj
+
+    def _record(self, obj, stream):
+        # the copies were allocated on the side stream; keep the allocator from reusing them too early
+        if torch.is_tensor(obj):
+            obj.record_stream(stream)
+        elif isinstance(obj, (list, tuple)):
+            for o in obj:
+                self._record(o, stream)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        with torch.cuda.stream(self.stream):
+            next_batch = self._to_device(next(it, None))
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            batch = next_batch
+            self._record(batch, current)
+            with torch.cuda.stream(self.stream):
+                next_batch = self._to_device(next(it, None))
+            yield batch
+
+def prefetch_to_device(loader, device):
+    """
+    Overlaps the host-to-device copies of loader with compute (see CUDAPrefetcher); loaders whose batches
+    already live on the device and non-CUDA devices are returned unchanged
+    """
+    if isinstance(loader, TabDSLoader) or torch.device(device).type != "cuda" or not torch.cuda.is_available():
+        return loader
+    return CUDAPrefetcher(loader, device)
+
+def get_train_dataloader(ds, bptt=1000, shuffle=True, num_workers=1, drop_last=True, agg_k_grads=1, not_zs=True, persistent_workers=True):
+        ds_len = len(ds)
+
+        def num_batches(batch_size):
+            # len() of a DataLoader over ds, without building one
+            return ds_len // batch_size if drop_last else -(-ds_len // batch_size)
+
+        if num_batches(bptt) == 0:
             if not_zs:
                 n_batches = 10
             else:
                 n_batches = 1
             bptt = int(ds_len // n_batches)
-            dl = DataLoader(
-                ds, batch_size=bptt, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
-            )
-        while len(dl) % agg_k_grads != 0:
+        # (a bptt of 0 is left for the loader to reject)
+        while bptt > 0 and num_batches(bptt) % agg_k_grads != 0:
             bptt += 1
-            dl = DataLoader(
-                ds, batch_size=bptt, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
-            )
+        dl = tabds_loader(ds, bptt, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last, persistent_workers=persistent_workers)
             # raise ValueError(f'Number of batches {len(dl)} not divisible by {agg_k_grads}, please modify aggregation factor.')
         return dl, bptt
 
@@ -910,5 +1324,5 @@ def get_subset_dl(extra_prior_kwargs_dict, val_dl):
         # val_dl_small = copy.deepcopy(val_dl)
         # subset_indices = np.random.choice(len(val_dl.dataset), size=SMALL_VAL_SIZE, replace=False)
         val_dl_small_ds = Subset(val_dl.dataset, np.arange(SMALL_VAL_SIZE))
-        val_dl_small_dl = DataLoader(val_dl_small_ds, batch_size=val_dl.batch_size, shuffle=False, num_workers=val_dl.num_workers)
+        val_dl_small_dl = tabds_loader(val_dl_small_ds, val_dl.batch_size, shuffle=False, num_workers=val_dl.num_workers)
         return val_dl_small_dl
\ No newline at end of file
@@ -8,7 +8,6 @@ import warnings
 import pandas as pd
 import torch
 import wandb
-import uncertainty_metrics.numpy as um
 from sklearn.metrics import (
     accuracy_score,
     f1_score,
@@ -188,8 +187,8 @@ def run_eval(dataset_name, base_path, max_time):
             except Exception as e:
                 print("Error calculating ROC AUC: ", e)
                 results['Val_ROC_AUC'] = 0.0
-            # results['Val_ECE'] = np.round(um.ece(y_val, val_outputs, num_bins=30), 3).item()
-            results['Val_TACE'] = np.round(um.tace(y_val, val_outputs, num_bins=30), 3).item()
+            # results['Val_ECE'] = np.round(tabular_metrics.expected_calibration_error(y_val, val_outputs, num_bins=30), 3).item()
+            results['Val_TACE'] = np.round(tabular_metrics.thresholded_adaptive_calibration_error(y_val, val_outputs, num_bins=30), 3).item()
             results[f'Test_Accuracy'] = np.round(accuracy_score(y_test, test_predictions), 3).item()
             results[f'Test_Log_Loss'] = np.round(log_loss(y_test, test_outputs, labels=np.arange(num_classes)), 3).item()
             results[f'Test_F1_Weighted'] = np.round(f1_score(y_test, test_predictions, average='weighted'), 3).item()
@@ -202,8 +201,8 @@ def run_eval(dataset_name, base_path, max_time):
             except Exception as e:
                 print("Error calculating ROC AUC: ", e)
                 results['Test_ROC_AUC'] = 0.0
-            results['Test_ECE'] = np.round(um.ece(y_test, test_outputs, num_bins=30), 3).item()
-            results['Test_TACE'] = np.round(um.tace(y_test, test_outputs, num_bins=30), 3).item()
+            results['Test_ECE'] = np.round(tabular_metrics.expected_calibration_error(y_test, test_outputs, num_bins=30), 3).item()
+            results['Test_TACE'] = np.round(tabular_metrics.thresholded_adaptive_calibration_error(y_test, test_outputs, num_bins=30), 3).item()
             if isinstance(best_configs, pd.DataFrame) or isinstance(best_configs, pd.Series):
                 save_path = os.path.join(base_path, model_string + ".csv")
                 best_configs.to_csv(save_path)
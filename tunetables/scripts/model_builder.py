@@ -12,8 +12,10 @@ import tunetables.priors as priors
 from tunetables.train import train
 from tunetables.losses import Losses
 
-def save_model(model, path, filename, config_sample):
+def save_model(model, path, filename, config_sample, state_dict=None):
     config_sample = {**config_sample}
+    if state_dict is None:
+        state_dict = model.state_dict()
 
     def make_serializable(config_sample):
         if isinstance(config_sample, torch.Tensor):
@@ -36,12 +38,12 @@ def save_model(model, path, filename, config_sample):
     try:
         #TODO: something about the target path is making the model unhappy
         os.makedirs(os.path.join("./models_diff"), exist_ok=True)
-        torch.save((model.state_dict(), None, config_sample), target_path)
+        torch.save((state_dict, None, config_sample), target_path)
     except:
         # NOTE: This seems to work as long as you run the script from the base directory
         os.makedirs(os.path.join("./models_diff"), exist_ok=True)
         target_path = os.path.join("./models_diff", filename)
-        torch.save((model.state_dict(), None, config_sample), target_path)
+        torch.save((state_dict, None, config_sample), target_path)
 
 
 
@@ -76,6 +76,63 @@ def ece_metric(target, pred):
   return torchmetrics.functional.calibration_error(pred, target)
 
 
+def _binned_calibration_error(probs, labels, bin_upper_bounds):
+    """
+    Sum over bins of |accuracy - confidence| weighted by the bin share, as in uncertainty_metrics
+    """
+    if probs.numel() == 0:
+        return probs.new_zeros((), dtype=torch.float64)
+    num_bins = len(bin_upper_bounds) + 1
+    # bucketize(right=True) places x in bin i with bounds[i-1] <= x < bounds[i], like np.digitize
+    bin_indices = torch.bucketize(probs, bin_upper_bounds, right=True)
+    counts = torch.bincount(bin_indices, minlength=num_bins).to(torch.float64) + np.finfo(np.float64).eps
+    confidences = torch.bincount(bin_indices, weights=probs, minlength=num_bins) / counts
+    accuracies = torch.bincount(bin_indices, weights=labels, minlength=num_bins) / counts
+    return ((accuracies - confidences) * counts / len(probs)).abs().sum()
+
+def _as_prob_matrix(target, pred):
+    target = torch.as_tensor(target).long()
+    pred = torch.as_tensor(pred, device=target.device).to(torch.float64)
+    if pred.ndim == 2 and pred.shape[1] == 1:
+        pred = pred[:, 0]
+    if pred.ndim == 1:
+        # binary probabilities of the positive class
+        pred = torch.stack([1 - pred, pred], dim=1)
+    return target.to(pred.device), pred
+
+def expected_calibration_error(target, pred, num_bins=30):
+    """
+    Torch implementation of uncertainty_metrics.numpy.ece (evenly spaced bins over the top-label confidence),
+    computed on the device of pred
+    """
+    target, pred = _as_prob_matrix(target, pred)
+    confidence, predicted = pred.max(dim=1)
+    correct = (predicted == target).to(torch.float64)
+    keep = confidence > 0
+    bin_upper_bounds = torch.linspace(0, 1, num_bins + 1, dtype=torch.float64, device=pred.device)[1:]
+    return _binned_calibration_error(confidence[keep], correct[keep], bin_upper_bounds).item()
+
+def thresholded_adaptive_calibration_error(target, pred, num_bins=30, threshold=0.01):
+    """
+    Torch implementation of uncertainty_metrics.numpy.tace (per-class bins holding equal numbers of the
+    predictions above threshold), computed on the device of pred
+    """
+    target, pred = _as_prob_matrix(target, pred)
+    num_classes = pred.shape[1]
+    error = pred.new_zeros((), dtype=torch.float64)
+    for j in range(num_classes):
+        probs, labels = pred[:, j], (target == j).to(torch.float64)
+        keep = probs > threshold
+        probs, labels = probs[keep], labels[keep]
+        if probs.numel() == 0:
+            continue
+        # upper edges of adaptive bins; np.round and torch.round both round half to even
+        edge_indices = torch.round(torch.arange(num_bins, dtype=torch.float64, device=pred.device) * (len(probs) / num_bins))
+        edge_indices = edge_indices.long().clamp(max=len(probs) - 1)
+        bin_upper_bounds = torch.sort(probs).values[edge_indices][1:]
+        error += _binned_calibration_error(probs, labels, bin_upper_bounds) / num_classes
+    return error.item()
+
 def average_precision_metric(target, pred):
     target = torch.tensor(target) if not torch.is_tensor(target) else target
     pred = torch.tensor(pred) if not torch.is_tensor(pred) else pred
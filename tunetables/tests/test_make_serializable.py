@@ -0,0 +1,30 @@
+from tunetables.utils import make_serializable, _make_serializable_walk
+
+import torch
+import unittest
+import numpy as np
+
+class TestMakeSerializable(unittest.TestCase):
+    def test_matches_walk(self):
+        configs = [
+            {'a': 1, 'b': 2.5, 'c': 'x', 'd': None, 'e': True, 'f': [1, {'g': [2, 3]}]},
+            {'tensor': torch.ones(2), 'fn': print, 'np': np.float32(1.5), 'nested': {'t': torch.zeros(1)}},
+            {1: 'int key', 2.5: 'float key', 'list': [1, 2]},
+            {'tuple': (1, 2), 'nested': {'pair': ('a', 'b')}, 'list_of_tuples': [(1, 2)]},
+            {(1, 2): 'tuple key'},
+            [1, (2, 3), {'a': torch.ones(1)}],
+        ]
+        for config in configs:
+            expected = _make_serializable_walk(config)
+            result = make_serializable(config)
+            self.assertEqual(result, expected)
+            self.assertEqual(repr(result), repr(expected))
+
+    def test_keeps_int_keys_and_tuples(self):
+        result = make_serializable({1: (2, 3), 'a': {4: 'b'}})
+        self.assertEqual(list(result.keys()), [1, 'a'])
+        self.assertIsInstance(result[1], tuple)
+        self.assertEqual(list(result['a'].keys()), [4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+from tunetables.priors.real import SubsetMaker
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+class TestMutualInformationCache(unittest.TestCase):
+    def _data(self):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(200, 8))
+        y = (X[:, 0] > 0).astype(np.int64)
+        return X, y
+
+    def test_same_data_hits_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch.dict(os.environ, {"TABPFN_CACHE_DIR": cache_dir}):
+            X, y = self._data()
+            first = SubsetMaker(4, 0, "mutual_information", "random")
+            X_first, _ = first.mutual_information_subset(X, y)
+            cache_path = first._mutual_information_cache_path(X, y)
+            self.assertTrue(cache_path.exists())
+
+            # rebuild the arrays from scratch so only their contents match
+            X_again, y_again = self._data()
+            second = SubsetMaker(4, 0, "mutual_information", "random")
+            self.assertEqual(second._mutual_information_cache_path(X_again, y_again), cache_path)
+            with mock.patch("tunetables.priors.real.mutual_info_classif") as mi:
+                X_second, _ = second.mutual_information_subset(X_again, y_again)
+                mi.assert_not_called()
+            np.testing.assert_array_equal(X_first, X_second)
+
+    def test_object_arrays_are_not_cached(self):
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch.dict(os.environ, {"TABPFN_CACHE_DIR": cache_dir}):
+            X, y = self._data()
+            subset_maker = SubsetMaker(4, 0, "mutual_information", "random")
+            self.assertIsNone(subset_maker._mutual_information_cache_path(X.astype(object), y))
+            subset_maker.mutual_information_subset(X.astype(object), y)
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, "mi")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,11 @@ import argparse
 import time
 import yaml
 import json
+import tempfile
 from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import inspect
 import warnings
 from typing import Optional
 
@@ -17,7 +20,6 @@ from torch.amp import autocast, GradScaler
 from torch.utils.data import DataLoader
 from torch import nn
 import numpy as np
-import uncertainty_metrics.numpy as um
 from sklearn.metrics import (
     accuracy_score,
     f1_score,
@@ -29,11 +31,11 @@ import tunetables.utils as utils
 from tunetables.transformer import TransformerModel
 from tunetables.utils import get_cosine_schedule_with_warmup, get_openai_lr, StoreDictKeyPair, get_weighted_single_eval_pos_sampler, get_uniform_single_eval_pos_sampler
 import tunetables.priors as priors
-from tunetables.priors.real import SummarizeAfter, process_data, loop_translate, TabDS, preprocess_input, get_train_dataloader, get_shuffle_index, get_subset_dl
+from tunetables.priors.real import SummarizeAfter, process_data, loop_translate, TabDS, preprocess_input, get_train_dataloader, get_shuffle_index, get_subset_dl, tabds_loader, prefetch_to_device, bagging_loader
 from tunetables.losses import kl_divergence
 import tunetables.encoders as encoders
 import tunetables.positional_encodings as positional_encodings
-from tunetables.utils import init_dist, seed_all, EmbeddingConcatenator
+from tunetables.utils import init_dist, seed_all, seed_cpu, EmbeddingConcatenator
 
 class GPULossTracker:
     """Tracks average loss across batches while keeping everything on GPU until final computation."""
@@ -57,42 +59,79 @@ class GPULossTracker:
         self.running_loss.zero_()
         self.count = 0
 
+class StepTimer:
+    """Times consecutive phases of a training step with CUDA events (wall clock off the GPU)."""
+    def __init__(self, use_cuda_events):
+        self.use_cuda_events = use_cuda_events
+        self.marks = []
+
+    def mark(self) -> None:
+        """Mark the end of the current phase (and the start of the next)."""
+        if self.use_cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.marks.append(event)
+        else:
+            self.marks.append(time.time())
+
+    def elapsed(self) -> list:
+        """Seconds between consecutive marks; waits for the GPU."""
+        if self.use_cuda_events:
+            self.marks[-1].synchronize()
+            return [start.elapsed_time(end) / 1000 for start, end in zip(self.marks, self.marks[1:])]
+        return [end - start for start, end in zip(self.marks, self.marks[1:])]
+
+def _dump_json(obj, path, **kwargs):
+    # write next to the target and rename, so a crash never leaves a truncated file behind
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', suffix='.tmp', delete=False) as f:
+        json.dump(obj, f, **kwargs)
+    os.replace(f.name, path)
+
+def _append_jsonl(obj, path, mode='a'):
+    with open(path, mode) as f:
+        f.write(json.dumps(obj) + '\n')
+
 def real_data_eval_out(r_model, cl=1000, train_data=None, val_dl=None, softmax_temperature = torch.log(torch.tensor([0.8])), return_probs=False):
 
         verbose = False
 
         start_time = time.time()
-        td = copy.deepcopy(train_data)
-        num_classes_local = len(torch.unique(td[1]))
-        td[0] = td[0][:cl, ...]
-        td[1] = td[1][:cl, ...]
-        single_eval_pos = len(td[0])
+        num_classes_local = len(torch.unique(train_data[1]))
         device = next(r_model.parameters()).device
+        # the context is the same for every batch, so it is moved to the device once
+        td_x = train_data[0][:cl, ...].to(device, torch.float32)
+        td_y = train_data[1][:cl, ...].to(device, torch.float32)
+        single_eval_pos = len(td_x)
         softmax_temperature = softmax_temperature.to(device)
         with torch.inference_mode():
             # correct = 0
             # total = len(val_dl.dataset)
-            prediction_list = []
-            target_list = []
-            output_list = []
+            # per-batch results are written into buffers allocated on the first batch,
+            # so there are no per-batch host copies and no final torch.cat
+            n_eval = len(val_dl.dataset)
+            outputs_buf = targets_buf = None
+            offset = 0
             for batch, (data, targets, _) in enumerate(val_dl):
 
+                x, y = data[0], data[1]
                 #extra safeguard against learning from test set
-                data_temp_idx = torch.randperm(data[1].nelement())
-                data[1] = data[1].view(-1)[data_temp_idx].view(data[1].size())
+                data_temp_idx = torch.randperm(y.nelement())
+                y = y.view(-1)[data_temp_idx].view(y.size())
 
-                batch_data = tuple([torch.cat((td[0], data[0]), dim=0).to(torch.float32), torch.cat((td[1], data[1]), dim=0).to(torch.float32)])
-                output = r_model(tuple(e.to(device) if torch.is_tensor(e) else e for e in batch_data) if isinstance(batch_data, tuple) else batch_data.to(device)
-                    , single_eval_pos=single_eval_pos)
+                batch_data = (torch.cat((td_x, x.to(device, torch.float32, non_blocking=True)), dim=0),
+                              torch.cat((td_y, y.to(device, torch.float32, non_blocking=True)), dim=0))
+                output = r_model(batch_data, single_eval_pos=single_eval_pos)
                 output = output[:, 0:num_classes_local] / torch.exp(softmax_temperature)
                 output = torch.nn.functional.softmax(output, dim=-1)
-                output_list.append(output)
-                _, predicted = torch.max(output.cpu().data, 1)
-                prediction_list.append(predicted)
-                target_list.append(targets)
-            outputs = torch.cat(output_list, dim=0).cpu().numpy()
-            predictions = torch.cat(prediction_list, dim=0).cpu().numpy()
-            targets = torch.cat(target_list, dim=0).cpu().numpy()
+                if outputs_buf is None:
+                    outputs_buf = output.new_empty((n_eval,) + output.shape[1:])
+                    targets_buf = targets.new_empty((n_eval,) + targets.shape[1:])
+                outputs_buf[offset:offset + len(output)] = output
+                targets_buf[offset:offset + len(targets)] = targets
+                offset += len(output)
+            outputs = outputs_buf[:offset].cpu().numpy()
+            predictions = outputs_buf[:offset].argmax(1).cpu().numpy()
+            targets = targets_buf[:offset].cpu().numpy()
 
         results = dict()
         warnings.filterwarnings("ignore")
@@ -139,6 +178,13 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
     device = gpu_device if torch.cuda.is_available() else 'cpu:0'
     using_dist, rank, device = init_dist(device)
     start_time = time.time()
+    # result logs and prefix weights are written by one background thread (in submission order),
+    # so slow file systems do not stall training
+    io_executor = ThreadPoolExecutor(max_workers=1)
+    io_futures = []
+
+    def write_async(fn, *args, **kwargs):
+        io_futures.append(io_executor.submit(fn, *args, **kwargs))
 
     #set verbose to True
     if not verbose:
@@ -154,9 +200,13 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             print("Using current directory instead")
             extra_prior_kwargs_dict['save_path'] = os.getcwd()
 
+    save_path = extra_prior_kwargs_dict.get('save_path')
+    rand_seed = extra_prior_kwargs_dict.get('rand_seed')
+    average_ensemble = extra_prior_kwargs_dict.get('average_ensemble')
     max_time = extra_prior_kwargs_dict.get('max_time', 0)
     do_kl_loss = extra_prior_kwargs_dict.get('kl_loss', False)
-    n_workers = extra_prior_kwargs_dict.get('num_workers', 1)
+    # model_builder passes the configured worker count as 'workers'
+    n_workers = extra_prior_kwargs_dict.get('num_workers', extra_prior_kwargs_dict.get('workers', 1))
     extra_prior_kwargs_dict['do_impute'] = True
     extra_prior_kwargs_dict['ohe'] = False
     linear = extra_prior_kwargs_dict.get('linear', False)
@@ -301,15 +351,15 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             preprocess_type=extra_prior_kwargs_dict.get("preprocess_type", "none")
             summerize_after_prep=extra_prior_kwargs_dict.get("summerize_after_prep", "False")
 
-            X = preprocess_input(torch.from_numpy(X.copy().astype(np.float32)), preprocess_type, summerize_after_prep, args, is_train=True)    
-            X_val = preprocess_input(torch.from_numpy(X_val.copy().astype(np.float32)), preprocess_type, summerize_after_prep, args, is_train=False)  
-            X_test = preprocess_input(torch.from_numpy(X_test.copy().astype(np.float32)), preprocess_type, summerize_after_prep, args, is_train=False)
+            X = preprocess_input(torch.from_numpy(X.astype(np.float32, copy=False)), preprocess_type, summerize_after_prep, args, is_train=True)    
+            X_val = preprocess_input(torch.from_numpy(X_val.astype(np.float32, copy=False)), preprocess_type, summerize_after_prep, args, is_train=False)  
+            X_test = preprocess_input(torch.from_numpy(X_test.astype(np.float32, copy=False)), preprocess_type, summerize_after_prep, args, is_train=False)
             if args.summerize_after_prep:
                 X, X_val, X_test = SummarizeAfter(X, X_val, X_test, y, y_val, y_test, num_features, args)            
         else:
-            X = torch.from_numpy(X.copy().astype(np.float32))
-            X_val = torch.from_numpy(X_val.copy().astype(np.float32))
-            X_test = torch.from_numpy(X_test.copy().astype(np.float32))
+            X = torch.from_numpy(X.astype(np.float32, copy=False))
+            X_val = torch.from_numpy(X_val.astype(np.float32, copy=False))
+            X_test = torch.from_numpy(X_test.astype(np.float32, copy=False))
 
         #feature padding
         do_pf = extra_prior_kwargs_dict.get("pad_features", True)
@@ -323,13 +373,28 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             if (X_test.shape[1] < num_features):
                 X_test = pad_data(X_test)
 
-        train_ds = TabDS(X, y)
-        val_ds = TabDS(X_val, y_val)
-        test_ds = TabDS(X_test, y_test)
+        # categorical columns only keep their (permuted) positions if nothing re-mixed the columns;
+        # TabDS additionally checks that their values are small integers before compacting them
+        if n_features == dataset.num_features and not extra_prior_kwargs_dict.get("ohe", False) \
+                and not extra_prior_kwargs_dict.get("do_preprocess", False):
+            cat_idx = np.flatnonzero(np.isin(feat_idx, dataset.cat_idx))
+        else:
+            cat_idx = None
+
+        train_ds = TabDS(X, y, cat_idx=cat_idx)
+        val_ds = TabDS(X_val, y_val, cat_idx=cat_idx)
+        test_ds = TabDS(X_test, y_test, cat_idx=cat_idx)
+        # Datasets that comfortably fit on the GPU are uploaded once, batches are then gathered there directly.
+        # kl_loss feeds the raw batches to a CPU model, and zero-shot evaluation fits the sklearn-style classifier on
+        # data_for_fitting (drawn from these batches) with numpy, so both keep them on the host.
+        if torch.device(device).type == 'cuda' and not do_kl_loss and not do_zs:
+            if sum(ds.nbytes for ds in (train_ds, val_ds, test_ds)) < torch.cuda.mem_get_info(device)[0] // 4:
+                for ds in (train_ds, val_ds, test_ds):
+                    ds.to(device, non_blocking=True)
 
         return X, y, X_val, y_val, X_test, y_test, invert_perm_map, steps_per_epoch, num_classes, label_weights, train_ds, val_ds, test_ds
 
-    def make_dataloaders(bptt=bptt, not_zs=True):
+    def make_dataloaders(bptt=bptt, not_zs=True, persistent_workers=True):
 
         dl, bptt = get_train_dataloader(train_ds, 
                                   bptt=bptt, 
@@ -337,15 +402,12 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                                   num_workers=n_workers, 
                                   drop_last=True, 
                                   agg_k_grads=aggregate_k_gradients,
-                                  not_zs=not_zs)
+                                  not_zs=not_zs,
+                                  persistent_workers=persistent_workers)
 
-        val_dl = DataLoader(
-            val_ds, batch_size=min(bptt, y_val.shape[0] // 2), shuffle=False, num_workers=n_workers,
-        )
+        val_dl = tabds_loader(val_ds, min(bptt, y_val.shape[0] // 2), shuffle=False, num_workers=n_workers, persistent_workers=persistent_workers)
 
-        test_dl = DataLoader(
-            test_ds, batch_size=min(bptt, y_val.shape[0] // 2), shuffle=False, num_workers=n_workers,
-        )
+        test_dl = tabds_loader(test_ds, min(bptt, y_val.shape[0] // 2), shuffle=False, num_workers=n_workers, persistent_workers=persistent_workers)
         # Fix the prior data TabPFN will use for fitting when including real data points
         X_data_for_fitting = []
         y_data_for_fitting = []
@@ -365,7 +427,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
         #load data
         not_zs = extra_prior_kwargs_dict.get('zs_eval_ensemble', 0) == 0
         do_zs = (not not_zs) and (not do_kl_loss)
-        seed_all(extra_prior_kwargs_dict.get('rand_seed'))
+        seed_all(rand_seed)
 
         if do_kl_loss:
             if extra_prior_kwargs_dict['uniform_bptt'] == False:
@@ -460,7 +522,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             res_dict = dict(res_dict, **{"Val_" + k : v for k, v in val_results.items()})
             test_results = tpc_data_eval(cl=real_data_qty, X=data_for_fitting[0], y=data_for_fitting[1], X_val=X_test, y_val=y_test, ens_size=extra_prior_kwargs_dict.get('zs_eval_ensemble', 0))
             res_dict = dict(res_dict, **{"Test_" + k : v for k, v in test_results.items()})
-            with open(os.path.join(extra_prior_kwargs_dict.get('save_path'), 'zs_eval_ensemble.json'), 'w') as f:
+            with open(os.path.join(save_path, 'zs_eval_ensemble.json'), 'w') as f:
                 json.dump(res_dict, f)
             if extra_prior_kwargs_dict.get('wandb_log', False):
                 import wandb
@@ -539,8 +601,18 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
         pass
 
     model.to(device)
-    if using_dist:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[rank], output_device=rank, broadcast_buffers=False)
+    # independent ensemble members (bagging, random init) are spread over the ranks instead of sharing gradients
+    ens_parallel = using_dist and (extra_prior_kwargs_dict.get("bagging", False) or rand_init_ensemble) and not boosting and not do_concat
+    world_size = torch.distributed.get_world_size() if using_dist else 1
+    if using_dist and not ens_parallel:
+        # grads are views into the allreduce buckets (no extra copy); static_graph lets DDP reuse its bucket order,
+        # but boosting (autograd.grad on the output) and embedding concatenation change the graph between steps
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[rank], output_device=rank, broadcast_buffers=False,
+                                                          bucket_cap_mb=50, gradient_as_bucket_view=True,
+                                                          static_graph=not boosting and not do_concat)
+    # compiles in place (torch>=2.2), so state_dict keys and attribute access on model are unchanged
+    if extra_prior_kwargs_dict.get('compile_model', False) and hasattr(model, 'compile'):
+        model.compile()
     
     if not real_prior:
         dl.model = model
@@ -550,53 +622,80 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
         lr = get_openai_lr(model)
         if verbose:
             print(f"Using OpenAI max lr of {lr}.")
-    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
+    # the fused CUDA AdamW updates all parameters in a single kernel (torch>=2.0)
+    fused_adamw = torch.device(device).type == 'cuda' and 'fused' in inspect.signature(torch.optim.AdamW).parameters
+
+    def make_optimizer(params):
+        if fused_adamw:
+            return torch.optim.AdamW(params, lr=lr, weight_decay=weight_decay, fused=True)
+        return torch.optim.AdamW(params, lr=lr, weight_decay=weight_decay)
+
+    optimizer = make_optimizer(model.parameters())
     sched_obj = scheduler(optimizer, warmup_epochs, epochs if epochs is not None else 100) # when training for fixed time lr schedule takes 100 steps
 
-    scaler = GradScaler() if train_mixed_precision else None
+    # bf16 has the range of fp32, so it needs no loss scaling; fp16 + GradScaler remains the fallback.
+    # is_bf16_supported() also reports emulated bf16 on pre-Ampere GPUs, so check for native support (sm_80+)
+    use_bf16 = train_mixed_precision and torch.cuda.is_available() and torch.cuda.get_device_capability(device)[0] >= 8
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = GradScaler('cuda') if train_mixed_precision and not use_bf16 else None
 
     # check that everything uses up-to-date APIs
     utils.check_compatibility(dl)
 
     master_epoch_count = []
     
+    eval_ctx_cache = {}
+
+    def get_eval_ctx(train_data, cl):
+        # device copies of the first cl context rows (and the class count), reused until train_data is replaced
+        cached = eval_ctx_cache.get(cl)
+        if cached is None or cached[0] is not train_data[0] or cached[1] is not train_data[1]:
+            cached = (train_data[0], train_data[1], len(torch.unique(train_data[1])),
+                      train_data[0][:cl, ...].to(device, torch.float32), train_data[1][:cl, ...].to(device, torch.float32))
+            eval_ctx_cache[cl] = cached
+        return cached[2:]
+
     def real_data_eval(r_model, cl=1000, train_data=None, val_dl=None, softmax_temperature = torch.log(torch.tensor([0.8]))):
         start_time = time.time()
-        td = copy.deepcopy(train_data)
-        num_classes_local = len(torch.unique(td[1]))
-        td[0] = td[0][:cl, ...]
-        td[1] = td[1][:cl, ...]
-        single_eval_pos = len(td[0])
+        num_classes_local, td_x, td_y = get_eval_ctx(train_data, cl)
+        single_eval_pos = len(td_x)
         softmax_temperature = softmax_temperature.to(device)
         # print("In real data eval, eval set size: ", len(val_dl.dataset))
         with torch.inference_mode():
             # correct = 0
             # total = len(val_dl.dataset)
-            prediction_list = []
-            target_list = []
-            output_list = []
+            # per-batch results are written into buffers allocated on the first batch,
+            # so there are no per-batch host copies and no final torch.cat
+            n_eval = len(val_dl.dataset)
+            outputs_buf = targets_buf = None
+            offset = 0
             for batch, (data, targets, _) in enumerate(val_dl):
-                
+                x, y = data[0], data[1]
                 if extra_prior_kwargs_dict.get('debug', False):
                     # Extra safeguard against test set contamination, permute label order before passing into model
-                    data_temp_idx = torch.randperm(data[1].nelement())
-                    data[1] = data[1].view(-1)[data_temp_idx].view(data[1].size())
-
-                batch_data = tuple([torch.cat((td[0], data[0]), dim=0).to(torch.float32), torch.cat((td[1], data[1]), dim=0).to(torch.float32)])
-                output = r_model(tuple(e.to(device) if torch.is_tensor(e) else e for e in batch_data) if isinstance(batch_data, tuple) else batch_data.to(device)
-                    , single_eval_pos=single_eval_pos)
+                    data_temp_idx = torch.randperm(y.nelement())
+                    y = y.view(-1)[data_temp_idx].view(y.size())
+
+                batch_data = (torch.cat((td_x, x.to(device, torch.float32, non_blocking=True)), dim=0),
+                              torch.cat((td_y, y.to(device, torch.float32, non_blocking=True)), dim=0))
+                # evaluation forward passes use the bf16 training precision; softmax and the buffers stay in float32
+                with autocast('cuda', dtype=amp_dtype, enabled=use_bf16):
+                    output = r_model(batch_data, single_eval_pos=single_eval_pos)
+                output = output.float()
                 #invert permutation of labels
                 new_output = loop_translate(output, invert_perm_map)
                 output = new_output
                 output = output[:, 0:num_classes_local] / torch.exp(softmax_temperature)
                 output = torch.nn.functional.softmax(output, dim=-1)
-                output_list.append(output)
-                _, predicted = torch.max(output.cpu().data, 1)
-                prediction_list.append(predicted)
-                target_list.append(targets)
-            outputs = torch.cat(output_list, dim=0).cpu().numpy()
-            predictions = torch.cat(prediction_list, dim=0).cpu().numpy()
-            targets = torch.cat(target_list, dim=0).cpu().numpy()
+                if outputs_buf is None:
+                    outputs_buf = output.new_empty((n_eval,) + output.shape[1:])
+                    targets_buf = targets.new_empty((n_eval,) + targets.shape[1:])
+                outputs_buf[offset:offset + len(output)] = output
+                targets_buf[offset:offset + len(targets)] = targets
+                offset += len(output)
+            outputs = outputs_buf[:offset].cpu().numpy()
+            predictions = outputs_buf[:offset].argmax(1).cpu().numpy()
+            targets = targets_buf[:offset].cpu().numpy()
             # print("In real data eval, Targets: ", targets[:20])
 
         results = dict()
@@ -627,6 +726,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
     
     def train_epoch(e_model, e_optimizer, boost_this_epoch=False, eval_model=None, bptt_search=False):
         tracker = GPULossTracker(device=device)
+        nan_tracker = GPULossTracker(device=device)
         if max_time > 0 and time.time() - start_time > max_time:
             print("Max time reached. Exiting")
             exit(0)
@@ -639,11 +739,24 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
         loss_times = 0
         grad_times = 0
         step_time = 0
+        # step phases are timed only every timing_period steps, since timing GPU work needs a synchronize
+        timing_period = 100
+        use_cuda_events = torch.device(device).type == 'cuda'
         before_get_batch = time.time()
         batches_seen = 0
         shuffle_every_epoch = extra_prior_kwargs_dict.get('shuffle_every_epoch', False)
         permute_feature_pos = extra_prior_kwargs_dict.get('permute_feature_position_in_ensemble', False)
-        for batch, (data, targets, single_eval_pos) in enumerate(dl):
+        # a plain CrossEntropyLoss is called functionally with its own settings, skipping nn.Module.__call__ every step
+        functional_ce = type(criterion) is nn.CrossEntropyLoss
+        # draw the epoch's eval positions up front (same draws, same order); not when the loop itself
+        # reseeds (shuffle_every_epoch) or may consume random numbers in between (kl loss)
+        eval_positions = None
+        if not boosting and bptt_extra_samples is None and callable(single_eval_pos_gen) \
+                and not shuffle_every_epoch and not do_kl_loss:
+            eval_positions = [single_eval_pos_gen() for _ in range(len(dl))]
+        # kl loss feeds the host-side batch to eval_model.predict_proba
+        e_dl = dl if do_kl_loss else prefetch_to_device(dl, device)
+        for batch, (data, targets, single_eval_pos) in enumerate(e_dl):
             if isinstance(data, list):
                 data = tuple(data)
             if isinstance(single_eval_pos, torch.Tensor) and single_eval_pos.numel() == 0:
@@ -654,30 +767,38 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                 cm = nullcontext()
 
             if permute_feature_pos:
-                data = tuple([data[0][:, torch.randperm(data[0].shape[1])], data[1]])
+                # permutation drawn on the batch's device, so no index tensor is copied over
+                perm = torch.randperm(data[0].shape[1], device=data[0].device)
+                data = tuple([data[0].index_select(1, perm), data[1]])
             elif shuffle_every_epoch:
-                seed_all(extra_prior_kwargs_dict.get('rand_seed', 0) + len(master_epoch_count))
+                # only CPU generators feed this permutation; a device-side loader draws its batch order from its own
+                # generator, which is reseeded explicitly instead of resetting the global CUDA generators every step
+                step_seed = extra_prior_kwargs_dict.get('rand_seed', 0) + len(master_epoch_count)
+                seed_cpu(step_seed)
+                if getattr(dl, 'generator', None) is not None:
+                    dl.generator.manual_seed(step_seed)
                 perm_idx = torch.randperm(data[0].shape[0])
                 data = tuple([data[0][perm_idx, ...], data[1][perm_idx, ...]])
             with cm:
                 time_to_get_batch = time.time() - before_get_batch
                 time_to_get_batches += time_to_get_batch
-                before_forward = time.time()
+                timer = StepTimer(use_cuda_events) if batch % timing_period == 0 else None
+                if timer: timer.mark()
                 if boosting:
                     single_eval_pos = len(targets) // 2
+                elif eval_positions is not None:
+                    single_eval_pos = eval_positions[batch]
                 elif bptt_extra_samples is None:
                     single_eval_pos = single_eval_pos_gen() if callable(single_eval_pos_gen) else single_eval_pos_gen
                 else:
                     single_eval_pos = max(targets.shape[0] - bptt_extra_samples, 0)
-                with autocast('cuda', enabled=scaler is not None):
+                with autocast('cuda', dtype=amp_dtype, enabled=train_mixed_precision):
                     # If style is set to None, it should not be transferred to device
-                    output = e_model(tuple(e.to(torch.float32).to(device) if torch.is_tensor(e) else e for e in data) if isinstance(data, tuple) else data.to(device)
+                    output = e_model(tuple(e.to(torch.float32).to(device, non_blocking=True) if torch.is_tensor(e) else e for e in data) if isinstance(data, tuple) else data.to(device, non_blocking=True)
                                    , single_eval_pos=single_eval_pos)
                     if not bptt_search:
                         assert output.requires_grad, "Output does not require gradients"
-                    forward_time = time.time() - before_forward
-                    forward_times += forward_time
-                    before_backward = time.time()
+                    if timer: timer.mark()
                     if single_eval_pos is not None:
                         targets = targets[single_eval_pos:]
                     if isinstance(criterion, nn.GaussianNLLLoss):
@@ -685,11 +806,15 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                             'need to write a little bit of code to handle multiple regression targets at once'
                         mean_pred = output[..., 0]
                         var_pred = output[..., 1].abs()
-                        losses = criterion(mean_pred.flatten(), targets.to(device).flatten(), var=var_pred.flatten())
+                        losses = criterion(mean_pred.flatten(), targets.to(device, non_blocking=True).flatten(), var=var_pred.flatten())
                     elif isinstance(criterion, (nn.MSELoss, nn.BCEWithLogitsLoss)):
-                        losses = criterion(output.flatten(), targets.to(device).flatten())
+                        losses = criterion(output.flatten(), targets.to(device, non_blocking=True).flatten())
+                    elif functional_ce:
+                        losses = nn.functional.cross_entropy(output.reshape(-1, n_out), targets.to(device, non_blocking=True).long().flatten(),
+                                                             weight=criterion.weight, ignore_index=criterion.ignore_index,
+                                                             reduction=criterion.reduction, label_smoothing=criterion.label_smoothing)
                     elif isinstance(criterion, nn.CrossEntropyLoss):
-                        losses = criterion(output.reshape(-1, n_out), targets.to(device).long().flatten())
+                        losses = criterion(output.reshape(-1, n_out), targets.to(device, non_blocking=True).long().flatten())
                     elif do_kl_loss:
                         #TODO: investigate shape mismatches
                         real_data_preds = eval_model.predict_proba(data[0])
@@ -708,7 +833,6 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                         losses = criterion(output, targets)
                     if boosting or do_kl_loss:
                         loss = losses.mean()
-                        nan_share = torch.tensor([0])
                     else:
                         if len(output.shape) == 2:
                             output = output.unsqueeze(1)
@@ -716,6 +840,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
 
                         loss, nan_share = utils.torch_nanmean(losses.mean(0), return_nanshare=True)
                         loss = loss / aggregate_k_gradients
+                        nan_tracker.update(nan_share)
 
                 if scaler: loss = scaler.scale(loss)
                 if boosting and boost_this_epoch:
@@ -725,20 +850,17 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                         prior_grad_iter = None
                     else:
                         prior_grad_iter = prior_grad_dict[batch].to(output.device)
-                    output_grad = autograd.grad(loss, output)[0]
+                    if functional_ce and criterion.label_smoothing == 0 and not scaler:
+                        # closed form of the same gradient, without a backward pass through the loss
+                        output_grad = utils.cross_entropy_mean_grad(output, targets, criterion.weight, criterion.ignore_index)
+                    else:
+                        output_grad = autograd.grad(loss, output)[0]
                     gradient_dict[batch] = output_grad.detach().cpu().clone()
                     # cur_grads.append(output_grad.detach().cpu().clone())
 
                     if prior_grad_iter is not None:
-                        grad_shape = output_grad.shape
-                        flat_grad = output_grad.flatten()
-                        grad_signs = torch.sign(flat_grad)
-                        flat_prior_grad = prior_grad_iter.flatten()
                         cur_weight = 0.65
-                        flat_grad_new = torch.sqrt(cur_weight * torch.pow(flat_grad, 2) + (1 - cur_weight) * torch.pow(flat_prior_grad, 2))
-                        flat_grad_new_signs = torch.sign(flat_grad_new)
-                        flat_grad_new[flat_grad_new_signs != grad_signs] *= -1
-                        output_grad = flat_grad_new.reshape(grad_shape)
+                        output_grad = utils.mix_grads(output_grad, prior_grad_iter.reshape(output_grad.shape), cur_weight)
 
                     output.backward(output_grad)
                     # gradient_dict[batch] = torch.cat(cur_grads, dim=0)
@@ -746,7 +868,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                     pass
                 else:
                     loss.backward()      
-                backward_times += time.time() - before_backward
+                if timer: timer.mark()
                 tracker.update(loss)
                 if batch % aggregate_k_gradients == aggregate_k_gradients - 1:
                     if scaler: scaler.unscale_(e_optimizer)
@@ -759,9 +881,14 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                             e_optimizer.step()
                     except:
                         print("Invalid optimization step encountered")
-                    e_optimizer.zero_grad()
+                    e_optimizer.zero_grad(set_to_none=True)
 
-                step_time = time.time() - before_forward
+                if timer:
+                    timer.mark()
+                    forward_time, backward_time, optimizer_time = timer.elapsed()
+                    forward_times += forward_time
+                    backward_times += backward_time
+                    step_time = forward_time + backward_time + optimizer_time
             before_get_batch = time.time()
             batches_seen += 1
         #Total positional losses is a torch tensor of size bptt (batch size)
@@ -769,15 +896,16 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             raise ValueError("Not enough batches seen in epoch: saw {} batches, expected at least {}".format(batches_seen, extra_prior_kwargs_dict.get('min_batches_per_epoch', 1)))
         
         total_loss = tracker.average()
+        nan_share = nan_tracker.average()
 
         if verbose:
             print("train_epoch time: ", round(time.time() - epoch_start_time, 2))
             print("time to get batches: ", round(time_to_get_batches, 2))
-            print("time in forward: ", round(forward_times, 2))
-            print("time in backward: ", round(backward_times, 2))
+            print(f"time in forward (every {timing_period}th step): ", round(forward_times, 2))
+            print(f"time in backward (every {timing_period}th step): ", round(backward_times, 2))
 
         return total_loss, None,\
-               time_to_get_batch, forward_time, step_time, None,\
+               time_to_get_batch, forward_time, step_time, nan_share,\
                None
 
     def concat_embedding(ec, model, method):
@@ -802,14 +930,15 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                     #select random sample of size prefix_size
                     if "perm" in method:
                         # random permutation
-                        sel = torch.randperm(ec.concatenated_embedding.shape[0])[:ec.original_prefix_size].to(device)
+                        sel = torch.randperm(ec.concatenated_embedding.shape[0], device=device)[:ec.original_prefix_size]
                     else:
                         #first-k-samples
                         total_emb_size = ec.original_prefix_size
                         emb_size = total_emb_size // num_to_concat
                         orig_emb_size = ec.original_embedding.shape[0]
-                        start_pos = [j * orig_emb_size for j in range(num_to_concat)]
-                        sel = torch.cat([torch.arange(i, i+emb_size) for i in start_pos], dim=0).to(device)
+                        # the first emb_size rows of each of the num_to_concat embeddings
+                        start_pos = torch.arange(num_to_concat, device=device) * orig_emb_size
+                        sel = (start_pos[:, None] + torch.arange(emb_size, device=device)[None, :]).reshape(-1)
 
                     ec.concatenated_embedding = ec.concatenated_embedding[sel]
                     ec.concatenated_y_embedding = ec.concatenated_y_embedding[sel]
@@ -832,23 +961,44 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
     
     def save_prefix_weights(model, path, i, do_concat, prefix_weights_l):
         # Save prefix weights
-        prefix_weights = model.state_dict()['prefix_embedding.weight'].cpu().numpy()
+        # copy=True: on the CPU, .numpy() would share memory with tensors that training keeps updating
+        prefix_weights = model.prefix_embedding.weight.detach().to('cpu', copy=True).numpy()
         prefix_fn = f"prefix_weights_{i}.npy"
         prefix_save_path = os.path.join(path, prefix_fn)
         # if not is_wrapper:
-        np.save(prefix_save_path, prefix_weights)
-        prefix_y_labels = model.prefix_y_embedding.cpu().numpy()
+        write_async(np.save, prefix_save_path, prefix_weights, allow_pickle=False)
+        prefix_y_labels = model.prefix_y_embedding.to('cpu', copy=True).numpy()
         prefix_y_fn = f"prefix_y_labels_{i}.npy"
         prefix_y_save_path = os.path.join(path, prefix_y_fn)
 
         # if not is_wrapper:
-        np.save(prefix_y_save_path, prefix_y_labels)
+        write_async(np.save, prefix_y_save_path, prefix_y_labels, allow_pickle=False)
         if do_concat:
             prefix_weights_l.append({"prefix_weights": torch.from_numpy(prefix_weights).float(), "prefix_y_labels": torch.from_numpy(prefix_y_labels)})
             # print("Prefix weights list length: ", len(prefix_weights_l))
         return prefix_weights_l
 
+    ens_metric_cache = {}
+
     def update_ensemble_acc(ens_acc, ens_acc_nc, ens_acc_test, ens_acc_test_nc, num_classes):
+        if verbose:
+            # print("In update ensemble acc, Targets: ", labels_np[:20])
+            print("Ensemble accuracy: ", ens_acc, "Ensemble accuracy (NC): ", ens_acc_nc)
+        accs = {
+            "Ens_Val_Accuracy": ens_acc,
+            "Ens_Val_Accuracy_NC": ens_acc_nc,
+            "Ens_Test_Accuracy": ens_acc_test,
+            "Ens_Test_Accuracy_NC": ens_acc_test_nc,
+        }
+        # the F1/log loss/ROC metrics only depend on these arrays, which usually repeat from one ensemble round to the next
+        metric_inputs = [probs_np, labels_np, probs_np_test, labels_np_test]
+        if do_prompt_tuning:
+            metric_inputs += [probs_np_nc, labels_np_nc, probs_np_nc_test, labels_np_nc_test]
+        cached = ens_metric_cache.get(num_classes)
+        if cached is not None and all(a is b or np.array_equal(a, b) for a, b in zip(cached[0], metric_inputs)):
+            new_res = dict(cached[1])
+            new_res.update(accs)
+            return new_res
         num_classes_local_val = len(np.unique(labels_np))
         num_classes_local_test = len(np.unique(labels_np_test))
         predictions_np = np.argmax(probs_np, axis=1)
@@ -921,9 +1071,6 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             nc_test_f1_macro = 0
             nc_ll = 0
             nc_test_ll = 0
-        if verbose:
-            # print("In update ensemble acc, Targets: ", labels_np[:20])
-            print("Ensemble accuracy: ", ens_acc, "Ensemble accuracy (NC): ", ens_acc_nc)
         new_res = {
             "Ens_Val_Accuracy": ens_acc,
             "Ens_Val_Accuracy_NC": ens_acc_nc,
@@ -946,6 +1093,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             "Ens_Test_ROC_AUC": test_roc_auc,
             "Ens_Test_ROC_AUC_NC": test_roc_auc_nc,
         }
+        ens_metric_cache[num_classes] = (metric_inputs, dict(new_res))
         return new_res
 
     def train_test_loop(t_model, t_optim, t_sched, eval_model, dl, val_dl, test_dl):      
@@ -1004,7 +1152,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                         res_dict = dict(res_dict, **{"Val_concat_nc_" + k : v for k, v in val_score_nc_concat.items()})
                         t_model = restore_embedding(ec, t_model)
                         # Update optimizer parameters to include new embedding
-                        t_optim = torch.optim.AdamW(t_model.parameters(), lr=lr, weight_decay=weight_decay)
+                        t_optim = make_optimizer(t_model.parameters())
                         t_sched = scheduler(t_optim, warmup_epochs, epochs if epochs is not None else 100)
                     else:
                         val_score_nc_concat = ""
@@ -1076,10 +1224,9 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                         best_targets = return_targets
                     mstr = extra_prior_kwargs_dict.get('model_string')
                     boost_iter = f"ensemble_iter_{cur_boost_iter}" if is_ensemble else ""
-                    log_path = os.path.join(extra_prior_kwargs_dict.get('save_path'), f'{mstr}_{boost_iter}_log_{epoch}.json')
+                    log_path = os.path.join(save_path, f'{mstr}_{boost_iter}_log_{epoch}.json')
                     # if not is_wrapper:
-                    with open(log_path, 'w') as f:
-                        json.dump(res_dict, f, indent=4)
+                    write_async(_dump_json, copy.deepcopy(res_dict), log_path, indent=4)
 
                 if NO_PATIENCE:
                     break
@@ -1091,7 +1238,7 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
             t_model.prefix_embedding.weight = nn.Parameter(best_val_embed.to(device))
             #set requires grad to true
             t_model.prefix_embedding.weight.requires_grad = True
-            t_optim = torch.optim.AdamW(t_model.parameters(), lr=lr, weight_decay=weight_decay)
+            t_optim = make_optimizer(t_model.parameters())
             t_sched = scheduler(t_optim, warmup_epochs, epochs if epochs is not None else 100)
             v_scr, val_outputs, val_targets = real_data_eval(r_model=t_model, cl=real_data_qty, train_data=data_for_fitting, val_dl=val_dl)
             if (v_scr['Accuracy'] != best_res_dict['Val_Accuracy']) and verbose:
@@ -1140,14 +1287,12 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                 print("WARNING: subsampling was 0, using full dataset for bagging")
             split_size = len(dl.dataset)
         dl_backup = dl
-        split_indices = []
-        for i in range(boosting_n_iters):
-            np.random.seed(extra_prior_kwargs_dict.get('rand_seed') + i)
-            #NOTE: split sizes as absolute numbers
-            split_indices.append(np.random.choice(np.arange(len(dl_backup.dataset)), size=split_size, replace=True))
-            #NOTE: split sizes as percentages of the dataset
-            # split_size = 0.5
-            # split_indices.append(np.random.choice(np.arange(len(dl_backup.dataset)), size=int(split_size * len(dl_backup.dataset)), replace=False))
+        #NOTE: split sizes as absolute numbers; all bootstrap samples are drawn in one call, one row per member
+        rng = np.random.default_rng(rand_seed)
+        split_indices = rng.integers(0, len(dl_backup.dataset), size=(boosting_n_iters, split_size))
+        #NOTE: split sizes as percentages of the dataset
+        # split_size = 0.5
+        # split_indices = [rng.permutation(len(dl_backup.dataset))[:int(split_size * len(dl_backup.dataset))] for _ in range(boosting_n_iters)]
         # dl_backup = dl
         # split_indices = np.array_split(np.arange(len(dl_backup.dataset)), boosting_n_iters)
     is_ensemble = (boosting or bagging or rand_init_ensemble)
@@ -1159,7 +1304,65 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
     i = 0
     ensembling_acc = dict()
     res_dict_ensemble = dict()
+    member_targets = dict()
     best_results = dict()
+    prior_grad_dict = None
+    gradient_dict = {}
+
+    def train_member(i):
+        # trains ensemble member i (reloading the data first if reseed_data is set)
+        nonlocal X, y, X_val, y_val, X_test, y_test, invert_perm_map, steps_per_epoch, num_classes, label_weights, \
+            train_ds, val_ds, test_ds, dl, val_dl, test_dl, bptt, data_for_fitting, single_eval_pos_gen, dl_backup, \
+            cur_boost_iter, optimizer, sched_obj, prefix_weights_l, prior_grad_dict
+        next_seed = rand_seed + i
+        seed_all(next_seed)
+            
+        # extra_prior_kwargs_dict['rand_seed'] = next_seed
+
+        # members that reload the data get fresh loaders, so their worker pools are not kept alive
+        reload_data = extra_prior_kwargs_dict.get('reseed_data', True)
+        if reload_data:
+            #reset subset maker
+            # if getattr(dataset, "ssm", None) is not None:
+            #     delattr(dataset, "ssm")
+            #load data
+            extra_prior_kwargs_dict['do_impute'] = np.random.choice([True, False])
+            extra_prior_kwargs_dict['ohe'] = np.random.choice([True, False])
+            extra_prior_kwargs_dict['preprocess_type'] = np.random.choice(['none', 'power_all', 'robust_all', 'quantile_all'])
+            X, y, X_val, y_val, X_test, y_test, invert_perm_map, steps_per_epoch, num_classes, label_weights, train_ds, val_ds, test_ds = make_datasets(extra_prior_kwargs_dict, do_permute=not_zs, bptt=bptt, steps_per_epoch=steps_per_epoch, is_wrapper=is_wrapper)
+            old_bptt = bptt
+            dl, val_dl, test_dl, bptt, data_for_fitting  = make_dataloaders(bptt=bptt, persistent_workers=False)
+            if old_bptt != bptt:
+                if verbose:
+                    print("bptt changed from {} to {}".format(old_bptt, bptt))
+                if extra_prior_kwargs_dict.get('uniform_bptt', False): 
+                    single_eval_pos_gen = lambda: np.random.randint(0, bptt)
+                else:
+                    single_eval_pos_gen = bptt
+            if bagging:
+                dl_backup = dl
+        if bagging:
+            # reuses the previous bag's loader (and workers) unless the data was reloaded
+            dl = bagging_loader(dl_backup.dataset, split_indices[i], bptt, num_workers=n_workers, loader=dl,
+                                persistent_workers=not reload_data)
+        cur_boost_iter = i
+        print("Ensembling iteration: ", i+1, " of ", boosting_n_iters, "\n \n")
+        model.init_prefix_weights()
+        optimizer = make_optimizer(model.parameters())
+        sched_obj = scheduler(optimizer, warmup_epochs, epochs if epochs is not None else 100)
+        member_outputs, member_targets, results_dict = train_test_loop(model, optimizer, sched_obj, eval_model, dl, val_dl, test_dl)
+        if do_prompt_tuning:
+            prefix_weights_l = save_prefix_weights(model, save_path, i, do_concat, prefix_weights_l)
+        prior_grad_dict = gradient_dict
+        return member_outputs, member_targets, results_dict
+
+    def gather_member_round(round_start, member_res):
+        # shares the member each rank trained in this round with all ranks
+        gathered = [None] * world_size
+        torch.distributed.all_gather_object(gathered, member_res)
+        for j, res in enumerate(gathered):
+            if res is not None:
+                output_dict[round_start + j], member_targets[round_start + j], res_dict_ensemble[round_start + j] = res
 
     #***
     #train/ENSEMBLING 1st loop
@@ -1173,17 +1376,24 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
         else:
             topk_ens_key = "Ens_" + topk_key
         print("Starting training loop \n \n")
-        if bagging:
-            subset_dataset = Subset(dl_backup.dataset, split_indices[i])
-            dl, bptt = get_train_dataloader(subset_dataset, 
-                                            bptt=bptt, 
-                                            shuffle=True, 
-                                            num_workers=n_workers, 
-                                            drop_last=True, 
-                                            agg_k_grads=aggregate_k_gradients)
-        prior_grad_dict = None
-        gradient_dict = {}
-        output_dict[i], test_targets, results_dict = train_test_loop(model, optimizer, sched_obj, eval_model, dl, val_dl, test_dl)
+        if ens_parallel and rank > 0:
+            # member 0 is trained once, on rank 0; the other ranks train the remaining members of its round
+            gather_member_round(0, train_member(rank) if rank < boosting_n_iters else None)
+            test_targets, results_dict = member_targets[i], res_dict_ensemble[i]
+        else:
+            if bagging:
+                subset_dataset = Subset(dl_backup.dataset, split_indices[i])
+                dl, bptt = get_train_dataloader(subset_dataset, 
+                                                bptt=bptt, 
+                                                shuffle=True, 
+                                                num_workers=n_workers, 
+                                                drop_last=True, 
+                                                agg_k_grads=aggregate_k_gradients)
+            output_dict[i], test_targets, results_dict = train_test_loop(model, optimizer, sched_obj, eval_model, dl, val_dl, test_dl)
+            if do_prompt_tuning:
+                prefix_weights_l = save_prefix_weights(model, save_path, i, do_concat, prefix_weights_l)
+            if ens_parallel:
+                gather_member_round(0, (output_dict[i], test_targets, results_dict))
         res_dict_ensemble[i] = best_results = results_dict
         prior_grad_dict = gradient_dict
         #OUTPUT_DICT[0] contains val_outputs, test_outputs, val_outputs_nc, test_outputs_nc
@@ -1205,14 +1415,14 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                                                     res_dict_ensemble[i]['Test_Accuracy'], 
                                                     res_dict_ensemble[i]['Test_nc_Accuracy'],
                                                     len(np.unique(labels_np)))
-            if not do_concat:
-                with open(os.path.join(extra_prior_kwargs_dict.get('save_path'), 'ensembling_acc.json'), 'w') as f:
-                    json.dump(ensembling_acc, f, indent=4)
+            if not do_concat and rank == 0:
+                # one line per ensemble size in ensembling_acc.jsonl, plus the full summary in ensembling_acc.json,
+                # rewritten atomically each round so it is current if the run stops early
+                write_async(_append_jsonl, {i: ensembling_acc[i]}, os.path.join(save_path, 'ensembling_acc.jsonl'), mode='w')
+                write_async(_dump_json, copy.deepcopy(ensembling_acc), os.path.join(save_path, 'ensembling_acc.json'), indent=4)
                 if extra_prior_kwargs_dict.get('wandb_log', False):
                     import wandb
                     wandb.log(ensembling_acc[i], step=len(master_epoch_count), commit=True)
-        if do_prompt_tuning:
-            prefix_weights_l = save_prefix_weights(model, extra_prior_kwargs_dict.get('save_path'), i, do_concat, prefix_weights_l)
     except KeyboardInterrupt:
         pass
 
@@ -1221,47 +1431,19 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
     #***
 
     if is_ensemble:
+        member_outs = dict()
+        running_outs = dict()
         for i in range(1, boosting_n_iters):
-            next_seed = extra_prior_kwargs_dict.get('rand_seed') + i
-            seed_all(next_seed)
-            
-            # extra_prior_kwargs_dict['rand_seed'] = next_seed
-
-            if extra_prior_kwargs_dict.get('reseed_data', True):
-                #reset subset maker
-                # if getattr(dataset, "ssm", None) is not None:
-                #     delattr(dataset, "ssm")
-                #load data
-                extra_prior_kwargs_dict['do_impute'] = np.random.choice([True, False])
-                extra_prior_kwargs_dict['ohe'] = np.random.choice([True, False])
-                extra_prior_kwargs_dict['preprocess_type'] = np.random.choice(['none', 'power_all', 'robust_all', 'quantile_all'])
-                X, y, X_val, y_val, X_test, y_test, invert_perm_map, steps_per_epoch, num_classes, label_weights, train_ds, val_ds, test_ds = make_datasets(extra_prior_kwargs_dict, do_permute=not_zs, bptt=bptt, steps_per_epoch=steps_per_epoch, is_wrapper=is_wrapper)
-                old_bptt = bptt
-                dl, val_dl, test_dl, bptt, data_for_fitting  = make_dataloaders(bptt=bptt)
-                if old_bptt != bptt:
-                    if verbose:
-                        print("bptt changed from {} to {}".format(old_bptt, bptt))
-                    if extra_prior_kwargs_dict.get('uniform_bptt', False): 
-                        single_eval_pos_gen = lambda: np.random.randint(0, bptt)
-                    else:
-                        single_eval_pos_gen = bptt
-                if bagging:
-                    dl_backup = dl
-            if bagging:
-                subset_dataset = Subset(dl_backup.dataset, split_indices[i])
-                dl = DataLoader(
-                    subset_dataset, batch_size=bptt, shuffle=False, num_workers=n_workers, drop_last=True,
-                )
-            cur_boost_iter = i
-            print("Ensembling iteration: ", i+1, " of ", boosting_n_iters, "\n \n")
-            model.init_prefix_weights()
-            optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
-            sched_obj = scheduler(optimizer, warmup_epochs, epochs if epochs is not None else 100)
-            output_dict[i], test_targets, results_dict = train_test_loop(model, optimizer, sched_obj, eval_model, dl, val_dl, test_dl)
-            res_dict_ensemble[i] = results_dict
-            if do_prompt_tuning:
-                prefix_weights_l = save_prefix_weights(model, extra_prior_kwargs_dict.get('save_path'), i, do_concat, prefix_weights_l)
-            prior_grad_dict = gradient_dict
+            if ens_parallel:
+                # the members of a round are trained concurrently, one per rank, and then shared with all ranks,
+                # which all evaluate the ensemble in member order below (the first round was trained with member 0)
+                round_start = i - i % world_size
+                if i == round_start:
+                    member = round_start + rank
+                    gather_member_round(round_start, train_member(member) if member < boosting_n_iters else None)
+                test_targets = member_targets[i]
+            else:
+                output_dict[i], test_targets, res_dict_ensemble[i] = train_member(i)
 
             #No need to save ensembled results if we are concatenating; regular results are accurate
             if do_concat != "":
@@ -1275,31 +1457,59 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                 if verbose:
                     print("keeping top {} of {} models, per provided key {}".format(topk_ens_val, i+1, topk_key))
                 #sort by val score
-                sorted_res = sorted(res_dict_ensemble.items(), key=lambda x: x[1][topk_key], reverse=True)
+                # parallel rounds may already hold later members, which are not part of the ensemble yet
+                sorted_res = sorted(((j, res) for j, res in res_dict_ensemble.items() if j <= i), key=lambda x: x[1][topk_key], reverse=True)
                 models_to_include = [x[0] for x in sorted_res][:topk_ens_val]
             else:
                 models_to_include = list(range(i + 1))
-            # Evaluate average model on all available benchmarks
+            # the combination runs on the training device
+            if topk_ens_val > 0:
+                # the included set can change between rounds, so the included members' outputs are copied there once
+                # and kept; member scores never change, so a member that drops out of the top k never comes back
+                active_members = sorted(models_to_include)
+                for j in range(1, i + 1):
+                    if j not in active_members:
+                        member_outs.pop(j, None)
+                        output_dict.pop(j, None)
+                for j in [0] + active_members:
+                    if j not in member_outs:
+                        member_outs[j] = [torch.as_tensor(o, device=device) for o in output_dict[j]]
+            corrects = []
             for m in range(len(output_dict[0])):
-                total = len(test_targets[m])
-                if extra_prior_kwargs_dict.get('average_ensemble'):
-                        current_outs[m] = torch.zeros_like(torch.from_numpy(output_dict[0][m]))
-                        for j in range(i + 1):
-                            if j not in models_to_include:
-                                continue
-                            current_outs[m] += output_dict[j][m]
+                if topk_ens_val == 0:
+                    # every member is included, so only the newest one is folded into the running total
+                    # and no member's outputs need to be kept around
+                    if m not in running_outs:
+                        running_outs[m] = torch.as_tensor(output_dict[0][m], device=device).clone()
+                    newest = torch.as_tensor(output_dict[i][m], device=device)
+                    if average_ensemble:
+                        running_outs[m].add_(newest)
+                        current_outs[m] = running_outs[m] / (i + 1)
+                    else:
+                        running_outs[m].add_(newest, alpha=boosting_lr)
+                        current_outs[m] = running_outs[m]
+                # Evaluate average model on all available benchmarks
+                elif average_ensemble:
+                        # one stacked reduction instead of an add per member
+                        if active_members:
+                            current_outs[m] = torch.stack([member_outs[j][m] for j in active_members]).sum(0)
+                        else:
+                            current_outs[m] = torch.zeros_like(member_outs[0][m])
                         current_outs[m] /= (i + 1)
                 # Evaluate additive model
                 else:
-                    current_outs[m] = output_dict[0][m]
-                    for j in range(1, i + 1):
-                        if j not in models_to_include:
-                            continue
-                        boost_res = torch.mul(boosting_lr, torch.from_numpy(output_dict[j][m]))
-                        current_outs[m] += boost_res
-                _, current_preds[m] = torch.max(current_outs[m].cpu().data, 1)
-                correct = (current_preds[m] == torch.from_numpy(test_targets[m])).sum().item()
-                boosting_accs[m] = np.round(correct / total, 3)
+                    current_outs[m] = member_outs[0][m].clone()
+                    boosted = [member_outs[j][m] for j in active_members if j > 0]
+                    if boosted:
+                        current_outs[m].add_(torch.stack(boosted).sum(0), alpha=boosting_lr)
+                current_preds[m] = current_outs[m].argmax(1)
+                corrects.append((current_preds[m] == torch.as_tensor(test_targets[m], device=device)).sum())
+            # a single device-to-host copy for all benchmarks
+            for m, correct in enumerate(torch.stack(corrects).tolist()):
+                boosting_accs[m] = np.round(correct / len(test_targets[m]), 3)
+            if topk_ens_val == 0:
+                # member 0's outputs are still needed for the metrics below
+                del output_dict[i]
             #TODO: this should not be hard-coded
             #OUTPUT_DICT[0] contains val_outputs, test_outputs, val_outputs_nc, test_outputs_nc
             probs_np = output_dict[0][0]
@@ -1322,12 +1532,11 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                 best_ens_acc = cur_ens_acc
             else:
                 ens_patience += 1
-            if do_prompt_tuning:
-                prefix_weights_l = save_prefix_weights(model, extra_prior_kwargs_dict.get('save_path'), i, do_concat, prefix_weights_l)
             # Save ensembled accuracy
-            with open(os.path.join(extra_prior_kwargs_dict.get('save_path'), 'ensembling_acc.json'), 'w') as f:
-                json.dump(ensembling_acc, f, indent=4)
-            if extra_prior_kwargs_dict.get('wandb_log', False):
+            if rank == 0:
+                write_async(_append_jsonl, {i: ensembling_acc[i]}, os.path.join(save_path, 'ensembling_acc.jsonl'))
+                write_async(_dump_json, copy.deepcopy(ensembling_acc), os.path.join(save_path, 'ensembling_acc.json'), indent=4)
+            if extra_prior_kwargs_dict.get('wandb_log', False) and rank == 0:
                 import wandb
                 master_epoch_count.append(1)
                 wandb.log(ensembling_acc[i], step=len(master_epoch_count), commit=True)
@@ -1337,6 +1546,11 @@ def train(args, dataset, criterion, encoder_generator, emsize=200, nhid=200, nla
                 print("Early stopping after {} ensembles".format(i))
                 break
 
+    # wait for pending writes, re-raising any error they hit
+    io_executor.shutdown(wait=True)
+    for future in io_futures:
+        future.result()
+
     # break down training and return
     if rank == 0: # trivially true for non-parallel training
         if isinstance(model, torch.nn.parallel.DistributedDataParallel):
@@ -1402,18 +1616,35 @@ if __name__ == '__main__':
     if args.nhid is None:
         args.nhid = 2*args.emsize
 
+    # name -> factory tables; the factories defer attribute access, since not every prior/encoder module ships with this package
+    prior_loaders = {
+        'gp': lambda: priors.fast_gp.DataLoader,
+        'ridge': lambda: priors.ridge.DataLoader,
+        'stroke': lambda: priors.stroke.DataLoader,
+        'mix_gp': lambda: priors.fast_gp_mix.DataLoader,
+    }
+    criteria = {
+        'ce': lambda: nn.CrossEntropyLoss(reduction='none'),
+        'gaussnll': lambda: nn.GaussianNLLLoss(reduction='none', full=True),
+        'mse': lambda: nn.MSELoss(reduction='none'),
+    }
+    encoder_generators = {
+        'linear': lambda: encoders.Linear,
+        'mlp': lambda: encoders.MLP,
+        'positional': lambda: encoders.Positional,
+    }
+    pos_encoder_generators = {
+        'none': lambda: None,
+        'sinus': lambda: positional_encodings.PositionalEncoding,
+        'learned': lambda: positional_encodings.LearnedPositionalEncoding,
+        'paired_scrambled_learned': lambda: positional_encodings.PairedScrambledPositionalEncodings,
+    }
+
     prior = args.__dict__.pop('prior')
 
-    if prior == 'gp':
-        prior = priors.fast_gp.DataLoader
-    elif prior == 'ridge':
-        prior = priors.ridge.DataLoader
-    elif prior == 'stroke':
-        prior = priors.stroke.DataLoader
-    elif prior == 'mix_gp':
-        prior = priors.fast_gp_mix.DataLoader
-    else:
+    if prior not in prior_loaders:
         raise NotImplementedError(f'Prior == {prior}.')
+    prior = prior_loaders[prior]()
 
     loss_function = args.__dict__.pop('loss_function')
 
@@ -1423,14 +1654,9 @@ if __name__ == '__main__':
     min_y = args.__dict__.pop('min_y')
     # criterion = nn.MSELoss(reduction='none')
 
-    if loss_function == 'ce':
-        criterion = nn.CrossEntropyLoss(reduction='none')
-    elif loss_function == 'gaussnll':
-        criterion = nn.GaussianNLLLoss(reduction='none', full=True)
-    elif loss_function == 'mse':
-        criterion = nn.MSELoss(reduction='none')
-    else:
+    if loss_function not in criteria:
         raise NotImplementedError(f'loss_function == {loss_function}.')
+    criterion = criteria[loss_function]()
 
 
 
@@ -1438,31 +1664,18 @@ if __name__ == '__main__':
     y_encoder = args.__dict__.pop('y_encoder')
 
     def get_encoder_generator(encoder):
-        if encoder == 'linear':
-            encoder_generator = encoders.Linear
-        elif encoder == 'mlp':
-            encoder_generator = encoders.MLP
-        elif encoder == 'positional':
-            encoder_generator = encoders.Positional
-        else:
+        if encoder not in encoder_generators:
             raise NotImplementedError(f'A {encoder} encoder is not valid.')
-        return encoder_generator
+        return encoder_generators[encoder]()
 
     encoder_generator = get_encoder_generator(encoder)
     y_encoder_generator = get_encoder_generator(y_encoder)
 
     pos_encoder = args.__dict__.pop('pos_encoder')
 
-    if pos_encoder == 'none':
-        pos_encoder_generator = None
-    elif pos_encoder == 'sinus':
-        pos_encoder_generator = positional_encodings.PositionalEncoding
-    elif pos_encoder == 'learned':
-        pos_encoder_generator = positional_encodings.LearnedPositionalEncoding
-    elif pos_encoder == 'paired_scrambled_learned':
-        pos_encoder_generator = positional_encodings.PairedScrambledPositionalEncodings
-    else:
+    if pos_encoder not in pos_encoder_generators:
         raise NotImplementedError(f'pos_encoer == {pos_encoder} is not valid.')
+    pos_encoder_generator = pos_encoder_generators[pos_encoder]()
 
     permutation_invariant_max_eval_pos = args.__dict__.pop('permutation_invariant_max_eval_pos')
     permutation_invariant_sampling = args.__dict__.pop('permutation_invariant_sampling')
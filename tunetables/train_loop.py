@@ -2,15 +2,13 @@ import time
 from datetime import datetime
 import json
 import os
-
-import wandb
-import ConfigSpace
+from concurrent.futures import ThreadPoolExecutor
 
 from tunetables.scripts.model_builder import get_model, save_model
 from tunetables.scripts.model_configs import *
 from tunetables.priors.utils import uniform_int_sampler_f
 from tunetables.notebook_utils import *
-from tunetables.utils import make_serializable, wandb_init
+from tunetables.utils import make_serializable, wandb_init, get_default_num_workers
 
 def train_function(config_sample, i=0, add_name='', is_wrapper = False, x_wrapper = None, y_wrapper = None, cat_idx = []):
 
@@ -19,19 +17,25 @@ def train_function(config_sample, i=0, add_name='', is_wrapper = False, x_wrappe
         save_every_k = config_sample['epochs'] + 1
     else:
         save_every_k = config_sample['save_every_k_epochs']
-    epochs = []
+    epochs_seen = 0
+    last_saved_epoch = 0
+    # checkpoints are written by a background thread while training continues
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_futures = []
 
     def save_callback(model, epoch, values_to_log):
         #NOTE: I think the 'epoch' value is actually 1 / config['epochs']
-        epochs.append(epoch)
-        if not hasattr(model, 'last_saved_epoch'):
-            model.last_saved_epoch = 0
-        if len(epochs) % save_every_k == 0:
+        nonlocal epochs_seen, last_saved_epoch
+        epochs_seen += 1
+        if epochs_seen % save_every_k == 0:
             print('Saving model..')
             config_sample['epoch_in_training'] = epoch
-            save_model(model, config_sample['base_path'], f'prior_diff_real_checkpoint{add_name}_n_{i}_epoch_{model.last_saved_epoch}.cpkt',
-                           config_sample)
-            model.last_saved_epoch = model.last_saved_epoch + 1 # TODO: Rename to checkpoint
+            # snapshot the weights and config now, so later steps and config updates don't leak into the file
+            state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+            save_futures.append(save_executor.submit(save_model, model, config_sample['base_path'],
+                           f'prior_diff_real_checkpoint{add_name}_n_{i}_epoch_{last_saved_epoch}.cpkt',
+                           {**config_sample}, state_dict=state_dict))
+            last_saved_epoch += 1 # TODO: Rename to checkpoint
 
     def no_callback(model, epoch, values_to_log):
         pass
@@ -47,7 +51,12 @@ def train_function(config_sample, i=0, add_name='', is_wrapper = False, x_wrappe
                       , should_train=True
                       , state_dict=config_sample["state_dict"]
                       , epoch_callback = my_callback, is_wrapper = is_wrapper, x_wrapper = x_wrapper, y_wrapper = y_wrapper, cat_idx = cat_idx)
-    
+
+    # wait for pending checkpoints, re-raising any error they hit
+    save_executor.shutdown(wait=True)
+    for future in save_futures:
+        future.result()
+
     if is_wrapper:
         return model, data_for_fitting, test_loader
     else:
@@ -175,7 +184,7 @@ def reload_config(config_type='causal', task_type='multiclass', longer=0, args=N
     config['pad_features'] = args.pad_features
     config['reseed_data'] = args.reseed_data
     config['normalize_to_ranking'] = False # This should be kept to false, it has learning from the future issues
-    config['workers'] = args.workers
+    config['workers'] = args.workers if args.workers is not None else get_default_num_workers()
 
     #differential privacy
     config['private_model'] = args.private_model
@@ -200,6 +209,7 @@ def reload_config(config_type='causal', task_type='multiclass', longer=0, args=N
     config['data_path'] = args.data_path
     config["base_path"] = args.save_path
     config['train_mixed_precision'] = True
+    config['compile_model'] = args.compile_model
     config['linear'] = args.linear
 
     if args.resume is not None:
@@ -333,11 +343,12 @@ def parse_args():
     parser.add_argument('--real_data_qty', type=int, default=0, help='Number of real data samples to use for fitting.')
     parser.add_argument('--summerize_after_prep', action='store_true', help='train_feature_extractor.')
     parser.add_argument('--kl_loss', action='store_true', help='Whether to use KL loss.')
-    parser.add_argument('--workers', type=int, default=8, help='Number of workers for data loading.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of workers for data loading (default: derived from the available CPUs).')
     parser.add_argument('--private_model', action='store_true', help='Train model with differential privacy.')
     parser.add_argument('--private_data', action='store_true', help='Train with differential privacy added to the dataset.')
     parser.add_argument('--edg', nargs='+', type=str, default=["50", "1e-4", "1.2"], help="Epsilon, delta, gradnorm for differential privacy.")
     parser.add_argument('--linear', action='store_true', help='Whether to use a linear model.')
+    parser.add_argument('--compile_model', action='store_true', help='Whether to compile the model with torch.compile.')
     args = parser.parse_args()
     return args
 
@@ -362,6 +373,7 @@ def train_loop():
         wandb_init(config, model_string)
 
     #clean out optuna params
+    import ConfigSpace
     for k, v in config.items():
         if isinstance(v, ConfigSpace.hyperparameters.CategoricalHyperparameter):
             config[k] = v.default_value
@@ -369,6 +381,7 @@ def train_loop():
     results_dict = train_function(config, 0, model_string, is_wrapper = False)
 
     if config['wandb_log']:
+        import wandb
         wandb.finish()
     print("run complete")
     print("^RESULTS\n" + json.dumps(results_dict))
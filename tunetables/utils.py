@@ -5,13 +5,13 @@ import random
 import datetime
 import itertools
 import json
+import warnings
 
 import torch
 from torch import nn
 from torch.optim.lr_scheduler import LambdaLR
 import numpy as np
 
-import wandb
 
 def seed_all(seed = 0):
     # print('Setting random, numpy, torch seeds to', seed)
@@ -22,6 +22,12 @@ def seed_all(seed = 0):
     np.random.seed(seed)
     torch.manual_seed(seed)
 
+def seed_cpu(seed = 0):
+    # like seed_all, but leaves the CUDA generators (and cudnn flags) alone; for reseeding inside training loops
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.default_generator.manual_seed(seed)
+
 # copied from huggingface
 def get_cosine_schedule_with_warmup(optimizer, num_warmup_steps, num_training_steps, num_cycles=0.5, last_epoch=-1):
     """ Create a schedule with a learning rate that decreases following the
@@ -192,8 +198,9 @@ def torch_masked_mean(x, mask, dim=0, return_share_of_ignored_values=False):
     If return_share_of_ignored_values is true it returns a second tensor with the percentage of ignored values
     because of the mask.
     """
-    num = torch.where(mask, torch.full_like(x, 1), torch.full_like(x, 0)).sum(dim=dim)
-    value = torch.where(mask, x, torch.full_like(x, 0)).sum(dim=dim)
+    # counts are summed in x's dtype, like the values; a 0-dim zero avoids materializing full_like tensors
+    num = mask.sum(dim=dim, dtype=x.dtype)
+    value = torch.where(mask, x, x.new_zeros(())).sum(dim=dim)
     if return_share_of_ignored_values:
         return value / num, 1.-num/x.shape[dim]
     return value / num
@@ -203,11 +210,10 @@ def torch_masked_std(x, mask, dim=0):
     Returns the std of a torch tensor and only considers the elements, where the mask is true.
     If get_mean is true it returns as a first Tensor the mean and as a second tensor the std.
     """
-    num = torch.where(mask, torch.full_like(x, 1), torch.full_like(x, 0)).sum(dim=dim)
-    value = torch.where(mask, x, torch.full_like(x, 0)).sum(dim=dim)
+    num = mask.sum(dim=dim, dtype=x.dtype)
+    value = torch.where(mask, x, x.new_zeros(())).sum(dim=dim)
     mean = value / num
-    mean_broadcast = torch.repeat_interleave(mean.unsqueeze(dim), x.shape[dim], dim=dim)
-    quadratic_difference_from_mean = torch.square(torch.where(mask, mean_broadcast - x, torch.full_like(x, 0)))
+    quadratic_difference_from_mean = torch.square(torch.where(mask, mean.unsqueeze(dim) - x, x.new_zeros(())))
     return torch.sqrt(torch.sum(quadratic_difference_from_mean, dim=dim) / (num - 1))
 
 def torch_nanmean(x, dim=0, return_nanshare=False):
@@ -228,7 +234,7 @@ def normalize_data(data, normalize_positions=-1):
 
     return data
 
-def remove_outliers(X, n_sigma=4, normalize_positions=-1):
+def outlier_bounds(X, n_sigma=4, normalize_positions=-1):
     # Expects T, B, H
     assert len(X.shape) == 3, "X must be T,B,H"
 
@@ -242,12 +248,50 @@ def remove_outliers(X, n_sigma=4, normalize_positions=-1):
     data_mean, data_std = torch_masked_mean(data, mask), torch_masked_std(data, mask)
 
     cut_off = data_std * n_sigma
-    lower, upper = data_mean - cut_off, data_mean + cut_off
+    return data_mean - cut_off, data_mean + cut_off
+
+def _script(fn):
+    # scripted functions run their elementwise chains as one fused kernel on GPU
+    with warnings.catch_warnings():
+        # newer torch releases deprecate torch.jit.script in favour of torch.compile, which recompiles per input shape
+        warnings.simplefilter("ignore", FutureWarning)
+        return torch.jit.script(fn)
 
+def _clip_outliers_and_scale(X, lower, upper, scale: float = 1.):
     X = torch.maximum(-torch.log(1+torch.abs(X)) + lower, X)
     X = torch.minimum(torch.log(1+torch.abs(X)) + upper, X)
-            # print(ds[1][data < lower, col], ds[1][data > upper, col], ds[1][~np.isnan(data), col].shape, data_mean, data_std)
-    return X
+    return X / scale
+
+clip_outliers_and_scale = _script(_clip_outliers_and_scale)
+
+def remove_outliers(X, n_sigma=4, normalize_positions=-1):
+    lower, upper = outlier_bounds(X, n_sigma=n_sigma, normalize_positions=normalize_positions)
+    return clip_outliers_and_scale(X, lower, upper)
+
+def _mix_grads(grad, prior_grad, weight: float):
+    # magnitude of the weighted quadratic mean, with the sign of grad (negative where grad is zero)
+    mixed = torch.sqrt(weight * (grad * grad) + (1 - weight) * (prior_grad * prior_grad))
+    return torch.where(grad > 0, mixed, -mixed)
+
+mix_grads = _script(_mix_grads)
+
+@torch.no_grad()
+def cross_entropy_mean_grad(logits, targets, weight=None, ignore_index=-100):
+    """
+    Analytic gradient of cross_entropy(logits.reshape(-1, C), targets.flatten(), weight, reduction='none').mean()
+    with respect to logits: weight[t] * (softmax(logits) - onehot(t)) / N, and zero for ignored targets.
+    """
+    n_out = logits.shape[-1]
+    targets = targets.reshape(-1).to(logits.device).long()
+    valid = targets != ignore_index
+    safe_targets = torch.where(valid, targets, torch.zeros_like(targets))
+    grad = logits.reshape(-1, n_out).float().softmax(-1)
+    grad.scatter_add_(1, safe_targets.unsqueeze(1), -torch.ones_like(grad[:, :1]))
+    scale = valid.float() / targets.numel()
+    if weight is not None:
+        scale = scale * weight.float()[safe_targets]
+    grad *= scale.unsqueeze(1)
+    return grad.view(logits.shape).to(logits.dtype)
 
 def bool_mask_to_att_mask(mask):
     return mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
@@ -265,6 +309,19 @@ def print_on_master_only(is_master):
     __builtin__.print = print
 
 
+def get_default_num_workers(max_workers=8):
+    """
+    Number of data loading workers for this process: ~90% of the CPUs available to it, shared between the
+    processes of a distributed run (one per GPU), capped at max_workers.
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+    distributed = 'LOCAL_RANK' in os.environ or ('SLURM_PROCID' in os.environ and torch.cuda.device_count() > 1)
+    world_size = max(1, torch.cuda.device_count()) if distributed else 1
+    return max(1, min(max_workers, int(n_cpus * 0.9) // world_size))
+
 def init_dist(device):
     #print('init dist')
     if 'LOCAL_RANK' in os.environ:
@@ -384,19 +441,37 @@ def is_json_serializable(obj):
     except (TypeError, OverflowError):
         return False
 
-def make_serializable(config_sample):
+def _serializable_default(obj):
+    return "tensor" if isinstance(obj, torch.Tensor) else str(obj)
+
+def _make_serializable_walk(config_sample):
     if isinstance(config_sample, torch.Tensor):
         config_sample = "tensor"
     if isinstance(config_sample, dict):
-        config_sample = {k: make_serializable(config_sample[k]) for k in config_sample}
+        config_sample = {k: _make_serializable_walk(config_sample[k]) for k in config_sample}
     if isinstance(config_sample, list):
-        config_sample = [make_serializable(v) for v in config_sample]
+        config_sample = [_make_serializable_walk(v) for v in config_sample]
     if callable(config_sample):
         config_sample = str(config_sample)
     if not is_json_serializable(config_sample):
         config_sample = str(config_sample)
     return config_sample
 
+def _json_round_trip_safe(config_sample):
+    # a json round trip turns tuples into lists and non-str dict keys into strings, which the walk keeps as they are
+    if isinstance(config_sample, dict):
+        return all(type(k) is str and _json_round_trip_safe(v) for k, v in config_sample.items())
+    if isinstance(config_sample, list):
+        return all(_json_round_trip_safe(v) for v in config_sample)
+    return not isinstance(config_sample, tuple)
+
+def make_serializable(config_sample):
+    # a single encoder pass when it gives the same result as the per-node walk; anything json can't encode
+    # (tensors, callables, numpy scalars, ConfigSpace hyperparameters) is replaced by the same placeholder or str()
+    if _json_round_trip_safe(config_sample):
+        return json.loads(json.dumps(config_sample, default=_serializable_default))
+    return _make_serializable_walk(config_sample)
+
 def get_wandb_api_key(api_key_file="./config/wandb_api_key.txt"):
     # todo: if we make a config folder, put wandb_api_key.txt into the config folder
     try:
@@ -407,6 +482,7 @@ def get_wandb_api_key(api_key_file="./config/wandb_api_key.txt"):
         return key.strip()
     
 def wandb_init(config, model_string):
+    import wandb
     mkey = get_wandb_api_key()
     wandb.login(key=mkey)
     simple_config = make_serializable(config)